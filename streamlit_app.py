@@ -1,7 +1,28 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import requests
 import os
+import sys
 import json
+import shutil
+import tempfile
+import io
+import hashlib
+import random
+import argparse
+import cProfile
+import pstats
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+from PIL import Image
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Set page config
 st.set_page_config(
@@ -10,93 +31,1474 @@ st.set_page_config(
     layout="wide"
 )
 
+# Overridable so a replay can point the app at the local HeyGen stub
+HEYGEN_API_BASE = os.getenv("HEYGEN_API_BASE", "https://api.heygen.com")
+
+# Key pool tuning
+KEY_ERROR_WINDOW = 20  # number of recent calls used to compute a key's error rate
+KEY_EJECT_SECONDS = {401: 600, 429: 60}  # how long a key sits out after these statuses
+KEY_QUOTA_REFRESH_SECONDS = 300
+
+# Circuit breaker tuning, per HeyGen endpoint
+BREAKER_FAILURE_THRESHOLD = 3  # consecutive failed or slow calls before a breaker opens
+BREAKER_SLOW_CALL_SECONDS = 3.0  # calls slower than this count as failures
+BREAKER_SLOW_CALL_OVERRIDES = {
+    # Opening a streaming session routinely takes longer than a plain API call
+    "POST /v1/streaming.new": 15.0,
+    "POST /v1/streaming.start": 15.0,
+}
+BREAKER_SAFE_PROBE = ("GET", "/v1/streaming.list")  # probes POST endpoints without opening or stopping sessions
+BREAKER_PROBE_INTERVAL_SECONDS = 15  # how often an open breaker probes the endpoint in the background
+
+# Access tokens are reused across reruns for this long, so avatar component args stay stable
+ACCESS_TOKEN_REUSE_SECONDS = 600
+
+# Voice picker
+VOICE_CATALOG_TTL_SECONDS = 3600
+VOICE_PAGE_SIZE = 25
+DEFAULT_VOICE_LABEL = "Default (No specific voice)"
+
+# Local cache directory for generated reports and assets
+CACHE_DIR = os.getenv("HEYGEN_CACHE_DIR", ".heygen_cache")
+HEALTH_REPORT_PATH = os.path.join(CACHE_DIR, "health_report.json")
+HEALTH_CHECK_WORKERS = 8
+
+# Avatar previews: downscaled thumbnails served from disk by Streamlit's static file server
+AVATAR_CATALOG_TTL_SECONDS = 3600
+PREVIEW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "avatar_previews")
+PREVIEW_INDEX_PATH = os.path.join(CACHE_DIR, "avatar_previews.json")
+PREVIEW_SIZE = (160, 160)
+PREVIEW_CACHE_MAX_BYTES = 20 * 1024 * 1024  # least recently shown thumbnails are evicted past this
+PREVIEW_FETCH_WORKERS = 4
+PREVIEW_METADATA_FIELDS = ("avatar_name", "gender", "avatar_type", "preview_image_url")
+
+# Rerun profiling
+PROFILE_DIR = os.path.join(CACHE_DIR, "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.005  # seconds between stack samples in sampling mode
+PROFILE_TOP_FUNCTIONS = 15
+PROFILE_HISTORY = 5  # profiled reruns kept in session state for display
+PROFILE_FILES_KEPT = 20  # profiled reruns whose files are kept in PROFILE_DIR
+
+# Session record and replay
+RECORDING_DIR = os.getenv("HEYGEN_RECORDING_DIR", os.path.join(CACHE_DIR, "recordings"))
+RECORD_ALL_SESSIONS = os.getenv("HEYGEN_RECORD_SESSIONS") == "1"  # record every browser session, e.g. in production
+RECORDING_SKIPPED_KEYS = {
+    "recorder", "client_id", "access_token", "profile_results", "profile_reruns_left", "profile_mode",
+    "resume_token", "live_sessions",
+}
+# Credentials in HeyGen requests, responses and session data; recordings keep a placeholder instead
+RECORDING_REDACTED_FIELDS = {"token", "access_token", "url", "realtime_endpoint", "ice_servers", "ice_servers2", "credential"}
+RECORDING_REDACTED = "REDACTED"
+# Background calls (key quota refresh, breaker probes) that aren't recorded and don't mean a replay diverged
+REPLAY_BACKGROUND_PATHS = {"/v2/user/remaining_quota", BREAKER_SAFE_PROBE[1]}
+
+# Instructor dashboard
+SESSION_IDLE_SECONDS = 1800  # students with no activity for this long drop off the dashboard
+REGISTRY_CHANGE_LOG = 5000  # changes remembered for incremental dashboard updates
+DASHBOARD_HEARTBEAT_SECONDS = 5  # the dashboard wakes at least this often, which also lets Streamlit stop it
+
+# Avatar session resume
+RESUME_GRACE_SECONDS = 120  # a re-rendered avatar reattaches to its HeyGen session if it was heard from this recently
+KEEP_ALIVE_SECONDS = 60  # how often a connected avatar pings HeyGen; must stay below RESUME_GRACE_SECONDS
+RESUME_COOKIE = "heygen_resume"
+
+# Avatar, voice and scenario text for each character in each scenario
+SCENARIOS = {
+    "Pre-briefing": {
+        "character": "Noa Martinez",
+        "role": "Virtual Clinical Instructor",
+        "avatar_id": "June_HR_public",
+        "voice_id": "c67d6fca1c3d4f55b81fcf9abc37d77f",
+        "key_prefix": "noa",
+        # Voice configuration options; the first one is the default
+        "voice_styles": {
+            "Friendly": {"rate": 1.0, "emotion": "friendly"},
+            "Professional": {"rate": 0.9, "emotion": "serious"},
+            "Enthusiastic": {"rate": 1.1, "emotion": "excited"},
+            "Calm": {"rate": 0.8, "emotion": "soothing"},
+        },
+        "tab_label": "👋 Pre-briefing with Noa Martinez",
+        "title": "Pre-briefing with Noa Martinez",
+        "opening_line": "Hello! I'm Noa Martinez, ready for our simulation today.",
+        # Replies, in order, to the student's lines in text-only mode; the last one repeats
+        "text_script": [
+            "Thanks for joining me. Before you meet Sam, tell me what you already know about him and the facility.",
+            "Good. Sam has 14 years in corrections and his first concern will be security and operations. "
+            "How will you open the conversation so he hears that you understand that?",
+            "That works. Expect pushback on cost, staffing and moving people around the facility. "
+            "Which of those do you think will matter most to him?",
+            "Have an answer ready for that one, and think about a phased rollout he can try on a single unit first.",
+            "You're ready. Head to the Simulation tab when you want to meet Sam, and come back here if you need to regroup.",
+        ],
+        "briefing_title": "📋 Scenario Background",
+        "briefing": """
+        **Pre-briefing Instructions:**
+        
+        In this scenario, you'll be playing the role of a public health nurse meeting with Sam Richards, 
+        an Operations Manager at a County Corrections Facility. Your goal is to discuss and negotiate the 
+        implementation of a new flu vaccination program for incarcerated individuals.
+        
+        **Key Learning Objectives:**
+        - Practice professional communication in challenging environments
+        - Develop negotiation skills for public health initiatives
+        - Understand the unique challenges of healthcare in correctional facilities
+        
+        **Character Background - Sam Richards:**
+        - 14 years experience in corrections management
+        - Generally resistant to change and new programs
+        - Focuses on security and operational concerns
+        - May be skeptical about healthcare initiatives
+        """
+    },
+    "Simulation": {
+        "character": "Sam Richards",
+        "role": "Operations Manager, County Corrections Facility",
+        "avatar_id": "Shawn_Therapist_public",
+        "voice_id": "0f6610678bfa4a1eb827d128662dca11",
+        "key_prefix": "sam",
+        "voice_styles": {
+            "Professional": {"rate": 0.9, "emotion": "serious"},
+            "Authoritative": {"rate": 0.85, "emotion": "serious"},
+            "Friendly": {"rate": 1.0, "emotion": "friendly"},
+            "Skeptical": {"rate": 0.8, "emotion": "serious"},
+        },
+        "tab_label": "🏥 Simulation: Meeting with Sam Richards",
+        "title": "Simulation: Meeting with Sam Richards",
+        "opening_line": "Hello! I'm Sam Richards, ready for our simulation today.",
+        "text_script": [
+            "I've got about fifteen minutes. What's this about a flu program? We've run this place fine without one.",
+            "Every time someone brings in a new health program it means more movement, more escorts, more overtime. "
+            "Who's paying for that?",
+            "And security? I'm not having nurses walking the housing units with syringes during count.",
+            "Hm. If it really cuts down on sick calls and lockdowns, I might listen. "
+            "What would the first month look like?",
+            "One unit, on a schedule my shift supervisors sign off on. Put it in writing and I'll take it upstairs.",
+        ],
+        "briefing_title": "🎯 Simulation Guidelines",
+        "briefing": """
+        **Your Role:** Public Health Nurse
+        
+        **Objective:** Convince Sam Richards to implement a flu vaccination program
+        
+        **Expected Challenges:**
+        - Resistance to new procedures
+        - Concerns about cost and logistics
+        - Security and safety questions
+        - "We've always done it this way" mentality
+        
+        **Success Strategies:**
+        - Present clear health benefits
+        - Address operational concerns directly
+        - Propose phased implementation
+        - Emphasize regulatory compliance benefits
+        """
+    }
+}
+
+def _read_secret(name):
+    """Read a Streamlit secret, treating a missing secrets file as an unset value"""
+    if not st.secrets.load_if_toml_exists():
+        return None
+    return st.secrets.get(name)
+
+def load_api_keys():
+    """Collect HeyGen API keys from HEYGEN_API_KEYS (list or comma separated) and HEYGEN_API_KEY"""
+    pooled = _read_secret("HEYGEN_API_KEYS") or os.getenv("HEYGEN_API_KEYS") or []
+    if isinstance(pooled, str):
+        pooled = pooled.split(",")
+    
+    keys = list(pooled)
+    single_key = _read_secret("HEYGEN_API_KEY") or os.getenv("HEYGEN_API_KEY")
+    if single_key:
+        keys.append(single_key)
+    
+    # Drop blanks and duplicates while keeping the configured order
+    return list(dict.fromkeys(key.strip() for key in keys if key and key.strip()))
+
 # Environment setup
-HEYGEN_API_KEY = st.secrets.get("HEYGEN_API_KEY") or os.getenv("HEYGEN_API_KEY")
+HEYGEN_API_KEYS = load_api_keys()
+
+class NoHealthyKeyError(RuntimeError):
+    """Raised when every API key in the pool is temporarily ejected"""
+
+class APIKeyPool:
+    """Spread HeyGen calls across API keys by remaining quota and recent error rate"""
+    
+    def __init__(self, keys):
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._stats = {
+            key: {
+                "requests": 0,
+                "errors": 0,
+                "recent": deque(maxlen=KEY_ERROR_WINDOW),
+                "last_status": None,
+                "ejected_until": 0.0,
+                "remaining_quota": None,
+                "quota_checked_at": 0.0,
+            }
+            for key in keys
+        }
+    
+    def _score(self, stats, max_quota):
+        recent = stats["recent"]
+        error_rate = (len(recent) - sum(recent)) / len(recent) if recent else 0.0
+        # Keys with unknown quota are treated as average until the first refresh lands
+        quota = stats["remaining_quota"]
+        quota_weight = 1.0 if quota is None or not max_quota else quota / max_quota
+        return max(quota_weight * (1.0 - error_rate) ** 2, 0.01)
+    
+    def acquire(self, exclude=()):
+        """Pick a key at random, weighted by health; raises NoHealthyKeyError if none are usable"""
+        now = time.time()
+        with self._lock:
+            candidates = {
+                key: stats for key, stats in self._stats.items()
+                if stats["ejected_until"] <= now and key not in exclude
+            }
+            if not candidates:
+                raise NoHealthyKeyError("All HeyGen API keys are temporarily unavailable")
+            
+            quotas = [s["remaining_quota"] for s in candidates.values() if s["remaining_quota"] is not None]
+            max_quota = max(quotas, default=0)
+            keys = list(candidates)
+            weights = [self._score(candidates[key], max_quota) for key in keys]
+            
+            quota_stale = any(now - s["quota_checked_at"] > KEY_QUOTA_REFRESH_SECONDS for s in self._stats.values())
+            if quota_stale and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self.refresh_quotas, daemon=True).start()
+        
+        return random.choices(keys, weights=weights)[0]
+    
+    def record(self, key, status_code, retry_after=None):
+        """Record the outcome of a call; status_code is None for network errors"""
+        ok = status_code is not None and status_code < 400
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                return
+            stats["requests"] += 1
+            stats["recent"].append(ok)
+            stats["last_status"] = status_code
+            if not ok:
+                stats["errors"] += 1
+            if status_code in KEY_EJECT_SECONDS:
+                eject_seconds = KEY_EJECT_SECONDS[status_code]
+                if status_code == 429 and retry_after and str(retry_after).isdigit():
+                    eject_seconds = int(retry_after)
+                stats["ejected_until"] = time.time() + eject_seconds
+    
+    def refresh_quotas(self):
+        """Fetch the remaining quota for every key (runs on a background thread)"""
+        try:
+            for key in list(self._stats):
+                try:
+                    response = requests.get(
+                        f"{HEYGEN_API_BASE}/v2/user/remaining_quota",
+                        headers={"x-api-key": key},
+                        timeout=10
+                    )
+                    self.record(key, response.status_code, response.headers.get("Retry-After"))
+                    quota = None
+                    if response.status_code == 200:
+                        quota = response.json().get("data", {}).get("remaining_quota")
+                except Exception:
+                    self.record(key, None)
+                    quota = None
+                
+                with self._lock:
+                    self._stats[key]["quota_checked_at"] = time.time()
+                    if quota is not None:
+                        self._stats[key]["remaining_quota"] = quota
+        finally:
+            with self._lock:
+                self._refreshing = False
+    
+    def snapshot(self):
+        """Per-key usage counters for the Debug expander; keys appear only as their position and a short hash"""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for number, (key, stats) in enumerate(self._stats.items(), start=1):
+                recent = stats["recent"]
+                ejected_for = stats["ejected_until"] - now
+                rows.append({
+                    "key": f"#{number} ({hashlib.sha256(key.encode()).hexdigest()[:8]})",
+                    "requests": stats["requests"],
+                    "errors": stats["errors"],
+                    "recent error rate": f"{(len(recent) - sum(recent)) / len(recent):.0%}" if recent else "-",
+                    "remaining quota": stats["remaining_quota"],
+                    "last status": stats["last_status"],
+                    "state": f"ejected ({int(ejected_for)}s)" if ejected_for > 0 else "active",
+                })
+        return rows
+
+@st.cache_resource
+def get_key_pool():
+    """Process-wide key pool shared by every browser session"""
+    return APIKeyPool(HEYGEN_API_KEYS)
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a HeyGen endpoint whose breaker is open"""
+
+class CircuitBreaker:
+    """Stop calling an endpoint after repeated failures or slow calls, and probe it in the background until it recovers"""
+    
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.slow_call_seconds = BREAKER_SLOW_CALL_OVERRIDES.get(f"{method} {path}", BREAKER_SLOW_CALL_SECONDS)
+        # GETs and token minting are safe to repeat; other POSTs (session start/stop) must never be replayed
+        if method == "GET" or path == "/v1/streaming.create_token":
+            self.probe = (method, path)
+        else:
+            self.probe = BREAKER_SAFE_PROBE
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.calls = 0
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self.last_latency_ms = None
+        self.last_error = None
+    
+    def allow(self):
+        return self.state == "closed"
+    
+    def record(self, ok, latency, error=None):
+        """Record a call outcome; slow successes count as failures"""
+        if ok and latency > self.slow_call_seconds:
+            ok, error = False, f"slow response ({latency:.1f}s)"
+        
+        with self._lock:
+            self.calls += 1
+            self.last_latency_ms = round(latency * 1000)
+            if ok:
+                self.consecutive_failures = 0
+                return
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+            if self.state != "closed" or self.consecutive_failures < BREAKER_FAILURE_THRESHOLD:
+                return
+            self.state = "open"
+            self.opened_at = time.time()
+            self.trips += 1
+        
+        threading.Thread(target=self._probe_until_closed, daemon=True).start()
+    
+    def _probe_until_closed(self):
+        """Background recovery: send the endpoint's safe probe until it answers quickly without a server error"""
+        while self.state != "closed":
+            time.sleep(BREAKER_PROBE_INTERVAL_SECONDS)
+            with self._lock:
+                self.state = "half-open"
+            started = time.perf_counter()
+            try:
+                # Any non-5xx answer (even a 400 for the missing body) shows the endpoint is reachable
+                response = _pooled_request(*self.probe, timeout=self.slow_call_seconds * 2)
+                healthy = response.status_code < 500
+                error = None if healthy else f"HTTP {response.status_code}"
+            except Exception as e:
+                healthy, error = False, str(e)
+            latency = time.perf_counter() - started
+            
+            with self._lock:
+                self.last_latency_ms = round(latency * 1000)
+                if healthy and latency <= self.slow_call_seconds:
+                    self.state = "closed"
+                    self.consecutive_failures = 0
+                    self.opened_at = None
+                else:
+                    self.state = "open"
+                    self.last_error = error or f"slow response ({latency:.1f}s)"
+    
+    def snapshot(self):
+        return {
+            "endpoint": f"{self.method} {self.path}",
+            "state": self.state,
+            "open for (s)": round(time.time() - self.opened_at) if self.opened_at else None,
+            "calls": self.calls,
+            "failures": self.failures,
+            "trips": self.trips,
+            "last latency ms": self.last_latency_ms,
+            "last error": self.last_error,
+        }
+
+@st.cache_resource
+def get_breakers():
+    """Process-wide circuit breakers, one per HeyGen endpoint, created on first use"""
+    return {}
+
+def get_breaker(method, path):
+    breakers = get_breakers()
+    # setdefault is atomic for dicts, so concurrent sessions end up sharing one breaker
+    return breakers.setdefault(f"{method} {path}", CircuitBreaker(method, path))
+
+def breaker_metrics():
+    """Snapshot of every endpoint breaker for the Debug expander"""
+    return [breaker.snapshot() for breaker in list(get_breakers().values())]
+
+def _pooled_request(method, path, **kwargs):
+    """Call the HeyGen API with a key from the pool, moving to another key on 401/429"""
+    pool = get_key_pool()
+    extra_headers = kwargs.pop("headers", {})
+    kwargs.setdefault("timeout", 10)
+    tried = set()
+    
+    while True:
+        key = pool.acquire(exclude=tried)
+        tried.add(key)
+        
+        try:
+            response = requests.request(
+                method,
+                f"{HEYGEN_API_BASE}{path}",
+                headers={**extra_headers, "x-api-key": key},
+                **kwargs
+            )
+        except Exception:
+            pool.record(key, None)
+            raise
+        
+        pool.record(key, response.status_code, response.headers.get("Retry-After"))
+        if response.status_code not in KEY_EJECT_SECONDS or len(tried) >= len(HEYGEN_API_KEYS):
+            return response
+
+def heygen_request(method, path, **kwargs):
+    """Call the HeyGen API through the endpoint's circuit breaker and the key pool"""
+    breaker = get_breaker(method, path)
+    if not breaker.allow():
+        raise CircuitOpenError(f"HeyGen {path} is temporarily unavailable")
+    
+    started = time.perf_counter()
+    try:
+        response = _pooled_request(method, path, **kwargs)
+    except NoHealthyKeyError:
+        # Key problems are not endpoint problems, so the breaker is left alone
+        raise
+    except Exception as e:
+        breaker.record(False, time.perf_counter() - started, str(e))
+        raise
+    
+    latency = time.perf_counter() - started
+    ok = response.status_code < 500
+    breaker.record(ok, latency, None if ok else f"HTTP {response.status_code}")
+    
+    recorder = get_recorder()
+    if recorder:
+        recorder.record(
+            "http",
+            t=time.time() - latency,
+            source="server",
+            method=method,
+            path=path,
+            json=kwargs.get("json"),
+            status=response.status_code,
+            latency_ms=round(latency * 1000),
+            body=response.text
+        )
+    return response
+
+def heygen_available():
+    """Whether avatar sessions can be started right now (the token endpoint's breaker is closed)"""
+    return get_breaker("POST", "/v1/streaming.create_token").allow()
 
 def get_access_token():
     """Generate HeyGen access token from API key"""
-    if not HEYGEN_API_KEY:
+    if not HEYGEN_API_KEYS:
         st.error("⚠️ HeyGen API Key not found. Please add it to your Streamlit secrets.")
         st.stop()
     
     try:
-        response = requests.post(
-            "https://api.heygen.com/v1/streaming.create_token",
-            headers={"x-api-key": HEYGEN_API_KEY},
-            timeout=10
-        )
+        response = heygen_request("POST", "/v1/streaming.create_token")
         
         if response.status_code == 200:
             return response.json().get("data", {}).get("token")
+        elif not heygen_available():
+            # This failure tripped the breaker; main() shows text-only mode instead of an error
+            return None
         else:
             st.error(f"Failed to get access token: {response.status_code}")
             st.write(f"Response: {response.text}")
             return None
-            
+    
+    except CircuitOpenError:
+        # main() falls back to text-only mode
+        return None
     except Exception as e:
-        st.error(f"Error getting access token: {str(e)}")
+        if heygen_available():
+            st.error(f"Error getting access token: {str(e)}")
         return None
 
-def get_compatible_voices():
-    """Get list of voices compatible with streaming avatars"""
-    if not HEYGEN_API_KEY:
-        return {}
+def cached_session_token():
+    """This browser session's token if one can be used without calling HeyGen: the memoized one, else a live avatar's"""
+    token, minted_at = st.session_state.get("access_token", (None, 0))
+    if token and time.time() - minted_at < ACCESS_TOKEN_REUSE_SECONDS:
+        return token
+    live = next(iter(st.session_state.get("live_sessions", {}).values()), None)
+    return live["access_token"] if live else None
+
+def get_session_access_token():
+    """Reuse this browser session's access token across reruns, minting a new one when it gets old"""
+    token, minted_at = st.session_state.get("access_token", (None, 0))
+    if token and time.time() - minted_at < ACCESS_TOKEN_REUSE_SECONDS:
+        return token
     
-    try:
-        response = requests.get(
-            "https://api.heygen.com/v2/voices",
-            headers={"x-api-key": HEYGEN_API_KEY},
-            timeout=10
-        )
+    started = time.perf_counter()
+    token = get_access_token()
+    get_session_registry().update(get_client_id(), **{"token ms": round((time.perf_counter() - started) * 1000)})
+    if token:
+        st.session_state["access_token"] = (token, time.time())
+    return token
+
+class VoiceIndex:
+    """Voice catalog indexed by language, gender and streaming support, with word-prefix search"""
+    
+    def __init__(self, voices):
+        self.voices = {}
+        self.by_label = {}
+        self.by_language = defaultdict(set)
+        self.by_gender = defaultdict(set)
+        self.streaming = set()
+        words = []
         
-        if response.status_code == 200:
-            voices_data = response.json().get("data", {}).get("voices", [])
-            # Filter for voices that support streaming
-            compatible_voices = {}
-            for voice in voices_data:
-                if voice.get("support_streaming", True):  # Assume streaming support if not specified
-                    name = voice.get("name", "Unknown")
-                    compatible_voices[name] = {
-                        "voice_id": voice.get("voice_id"),
-                        "gender": voice.get("gender", "unknown"),
-                        "language": voice.get("language", "en")
-                    }
-            return compatible_voices
-        else:
-            st.warning(f"Could not fetch voices: {response.status_code}")
-            return {}
+        for voice in voices:
+            voice_id = voice.get("voice_id")
+            if not voice_id:
+                continue
+            name = voice.get("name") or "Unknown"
+            language = voice.get("language") or "Unknown"
+            gender = (voice.get("gender") or "unknown").lower()
+            label = f"{name} ({language}, {gender})"
+            if label in self.by_label:
+                label = f"{name} ({language}, {gender}, {voice_id[:8]})"
+            self.by_label[label] = voice_id
+            self.voices[voice_id] = {"name": name, "language": language, "gender": gender, "label": label}
+            self.by_language[language].add(voice_id)
+            self.by_gender[gender].add(voice_id)
+            if voice.get("support_streaming", True):  # Assume streaming support if not specified
+                self.streaming.add(voice_id)
+            words.extend((word, voice_id) for word in name.lower().split())
+        
+        # Sorted (word, voice_id) pairs so a prefix lookup is a bisect plus a short scan
+        words.sort()
+        self._words = words
+        self.languages = sorted(self.by_language)
+        self.genders = sorted(self.by_gender)
+    
+    def _prefix_matches(self, prefix):
+        matches = set()
+        for term in prefix.lower().split():
+            term_matches = set()
+            i = bisect_left(self._words, (term,))
+            while i < len(self._words) and self._words[i][0].startswith(term):
+                term_matches.add(self._words[i][1])
+                i += 1
+            matches = term_matches if not matches else matches & term_matches
+            if not matches:
+                break
+        return matches
+    
+    def search(self, prefix="", language=None, gender=None, streaming_only=True):
+        """Return voice ids matching every given filter, sorted by name"""
+        candidates = self.streaming if streaming_only else set(self.voices)
+        if language:
+            candidates = candidates & self.by_language.get(language, set())
+        if gender:
+            candidates = candidates & self.by_gender.get(gender, set())
+        if prefix.strip():
+            candidates = candidates & self._prefix_matches(prefix)
+        return sorted(candidates, key=lambda voice_id: self.voices[voice_id]["name"].lower())
+
+
+@st.cache_resource
+def get_catalog_responses():
+    """Latest response of each catalog endpoint, by path, for recordings made while the catalogs are cached"""
+    return {}
+
+def catalog_request(path):
+    """GET a catalog endpoint whose result is cached for the whole process, keeping the response for recordings"""
+    started = time.perf_counter()
+    response = heygen_request("GET", path)
+    if response.status_code == 200:
+        get_catalog_responses()[path] = {
+            "method": "GET",
+            "path": path,
+            "status": response.status_code,
+            "latency_ms": round((time.perf_counter() - started) * 1000),
+            "body": response.text,
+        }
+    return response
+
+@st.cache_resource(ttl=VOICE_CATALOG_TTL_SECONDS, show_spinner=False)
+def get_voice_index():
+    """Fetch the voice catalog once per TTL and index it; failures are not cached"""
+    response = catalog_request("/v2/voices")
+    response.raise_for_status()
+    return VoiceIndex(response.json().get("data", {}).get("voices", []))
+
+def load_voice_index():
+    """Get the indexed voice catalog, or None if it cannot be fetched"""
+    if not HEYGEN_API_KEYS:
+        return None
+    
+    try:
+        return get_voice_index()
+    except requests.HTTPError as e:
+        st.warning(f"Could not fetch voices: {e.response.status_code}")
+        return None
     except Exception as e:
         st.warning(f"Error fetching voices: {str(e)}")
-        return {}
+        return None
+
+def voice_picker(key_prefix, voice_index, default_voice_id=None):
+    """Searchable, paginated voice selector; returns the selected voice id or None for HeyGen's default voice"""
+    query = st.text_input(
+        "Search voices:",
+        key=f"{key_prefix}_voice_query",
+        placeholder="Type the start of a voice name..."
+    )
+    
+    filter_col1, filter_col2 = st.columns(2)
+    with filter_col1:
+        language = st.selectbox("Language:", ["Any"] + voice_index.languages, key=f"{key_prefix}_voice_language")
+    with filter_col2:
+        gender = st.selectbox("Gender:", ["Any"] + voice_index.genders, key=f"{key_prefix}_voice_gender")
+    
+    matches = voice_index.search(
+        query,
+        language=None if language == "Any" else language,
+        gender=None if gender == "Any" else gender
+    )
+    
+    # Only one page of results is sent to the browser
+    page_count = max(1, -(-len(matches) // VOICE_PAGE_SIZE))
+    page_key = f"{key_prefix}_voice_page"
+    if st.session_state.get(page_key, 1) > page_count:
+        st.session_state[page_key] = page_count
+    page = 1
+    if page_count > 1:
+        page = st.number_input(f"Page (of {page_count}):", min_value=1, max_value=page_count, key=page_key)
+    page_ids = matches[(page - 1) * VOICE_PAGE_SIZE:page * VOICE_PAGE_SIZE]
+    
+    # The options change with every filter, so the choice is remembered separately and
+    # kept selectable even when it falls outside the current results
+    chosen_key = f"{key_prefix}_voice_id"
+    # Start on the scenario's voice, which is the one the health check validates
+    st.session_state.setdefault(chosen_key, default_voice_id if default_voice_id in voice_index.voices else None)
+    current_voice = voice_index.voices.get(st.session_state.get(chosen_key))
+    current_label = current_voice["label"] if current_voice else DEFAULT_VOICE_LABEL
+    options = [DEFAULT_VOICE_LABEL] + [voice_index.voices[voice_id]["label"] for voice_id in page_ids]
+    if current_label not in options:
+        options.insert(1, current_label)
+    
+    selected_voice_key = st.selectbox(
+        "Voice Selection:",
+        options=options,
+        index=options.index(current_label),
+        key=f"{key_prefix}_voice_selection"
+    )
+    st.session_state[chosen_key] = voice_index.by_label.get(selected_voice_key)
+    st.caption(f"{len(matches)} matching streaming voices")
+    return st.session_state[chosen_key]
+
+class AvatarPreviewCache:
+    """Content-addressed avatar thumbnails and metadata on disk, bounded in size with LRU eviction"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._filling = False
+        try:
+            with open(PREVIEW_INDEX_PATH) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        # avatar_id -> metadata plus the digest of its thumbnail; digest -> size and last time shown
+        self.avatars = index.get("avatars", {})
+        self.files = {
+            digest: info for digest, info in index.get("files", {}).items()
+            if os.path.exists(self._path(digest))
+        }
+    
+    @staticmethod
+    def _path(digest):
+        return os.path.join(PREVIEW_DIR, f"{digest}.webp")
+    
+    def _save(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{PREVIEW_INDEX_PATH}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"avatars": self.avatars, "files": self.files}, f)
+        os.replace(tmp_path, PREVIEW_INDEX_PATH)
+    
+    def _evict(self):
+        total = sum(info["bytes"] for info in self.files.values())
+        for digest, info in sorted(self.files.items(), key=lambda item: item[1]["last_used"]):
+            if total <= PREVIEW_CACHE_MAX_BYTES:
+                break
+            total -= info["bytes"]
+            del self.files[digest]
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+    
+    def _fetch(self, url):
+        """Download and downscale one preview image; returns (digest, bytes) or None"""
+        try:
+            response = requests.get(url, timeout=10)
+            response.raise_for_status()
+            image = Image.open(io.BytesIO(response.content))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            image.thumbnail(PREVIEW_SIZE)
+            buffer = io.BytesIO()
+            image.save(buffer, "WEBP", quality=80)
+        except Exception:
+            # Network errors, and anything Pillow raises on a broken or oversized image (OSError,
+            # SyntaxError, DecompressionBombError, ...): that avatar just has no thumbnail
+            return None
+        
+        data = buffer.getvalue()
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(PREVIEW_DIR, exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest, len(data)
+    
+    def fill(self, avatars):
+        """Record avatar metadata and fetch the thumbnails not cached yet; meant for a background thread"""
+        with self._lock:
+            if self._filling:
+                return
+            self._filling = True
+        
+        try:
+            missing = {}
+            with self._lock:
+                for avatar in avatars:
+                    avatar_id = avatar.get("avatar_id") if isinstance(avatar, dict) else None
+                    if not avatar_id:
+                        continue
+                    cached = self.avatars.get(avatar_id, {})
+                    entry = {field: avatar.get(field) for field in PREVIEW_METADATA_FIELDS}
+                    # A changed preview URL means a new image
+                    if cached.get("preview_image_url") == entry["preview_image_url"]:
+                        entry["digest"] = cached.get("digest")
+                    self.avatars[avatar_id] = entry
+                    if isinstance(entry["preview_image_url"], str) and entry.get("digest") not in self.files:
+                        missing[avatar_id] = entry["preview_image_url"]
+            
+            with ThreadPoolExecutor(max_workers=PREVIEW_FETCH_WORKERS) as pool:
+                fetched = dict(zip(missing, pool.map(self._fetch, missing.values())))
+            with self._lock:
+                for avatar_id, result in fetched.items():
+                    if result:
+                        digest, size = result
+                        self.avatars[avatar_id]["digest"] = digest
+                        self.files[digest] = {"bytes": size, "last_used": time.time()}
+                self._evict()
+                self._save()
+        finally:
+            with self._lock:
+                self._filling = False
+    
+    def preview(self, avatar_id):
+        """Thumbnail URL and metadata for an avatar, or None if its thumbnail isn't cached yet"""
+        with self._lock:
+            entry = self.avatars.get(avatar_id)
+            if not entry or entry.get("digest") not in self.files:
+                return None
+            self.files[entry["digest"]]["last_used"] = time.time()
+        # Content-addressed, so the v= version lets browsers cache it for good
+        return {**entry, "url": f"app/static/avatar_previews/{entry['digest']}.webp?v={entry['digest']}"}
+
+@st.cache_resource
+def get_avatar_previews():
+    """Process-wide avatar preview cache, loaded from its index on disk"""
+    return AvatarPreviewCache()
+
+@st.cache_resource(ttl=AVATAR_CATALOG_TTL_SECONDS, show_spinner=False)
+def get_avatar_catalog():
+    """Fetch the streaming avatars once per TTL and fill the preview cache in the background; failures are not cached"""
+    response = catalog_request("/v2/avatars")
+    response.raise_for_status()
+    avatars_data = response.json().get("data", {}).get("avatars", [])
+    # Filter for streaming-compatible avatars
+    streaming_avatars = [
+        avatar for avatar in avatars_data 
+        if avatar.get("avatar_type") == "streaming" or 
+           avatar.get("name", "").lower() in ["monica", "josh", "anna", "wayne"]
+    ]
+    
+    # The scenario avatars are interactive avatars, which /v2/avatars may not list
+    interactive_avatars = []
+    try:
+        response = catalog_request("/v1/streaming/avatar.list")
+        response.raise_for_status()
+        interactive_avatars = [
+            {
+                "avatar_id": avatar.get("avatar_id"),
+                "avatar_name": avatar.get("pose_name"),
+                "avatar_type": "streaming",
+                "preview_image_url": avatar.get("normal_preview"),
+            }
+            for avatar in response.json().get("data") or []
+            if isinstance(avatar, dict)
+        ]
+    except Exception:
+        # Previews for the scenario avatars are a nice-to-have; the catalog itself still loads
+        pass
+    
+    scenario_avatar_ids = {config["avatar_id"] for config in SCENARIOS.values()}
+    preview_ids = {avatar.get("avatar_id") for avatar in streaming_avatars}
+    preview_avatars = list(streaming_avatars)
+    for avatar in avatars_data + interactive_avatars:
+        avatar_id = avatar.get("avatar_id")
+        if avatar_id in scenario_avatar_ids and avatar_id not in preview_ids and avatar.get("preview_image_url"):
+            preview_avatars.append(avatar)
+            preview_ids.add(avatar_id)
+    threading.Thread(target=get_avatar_previews().fill, args=(preview_avatars,), daemon=True).start()
+    return streaming_avatars
+
+def get_available_avatars():
     """Get list of available avatars"""
-    if not HEYGEN_API_KEY:
+    if not HEYGEN_API_KEYS:
         return []
     
     try:
-        response = requests.get(
-            "https://api.heygen.com/v2/avatars",
-            headers={"x-api-key": HEYGEN_API_KEY},
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            avatars_data = response.json().get("data", {}).get("avatars", [])
-            # Filter for streaming-compatible avatars
-            streaming_avatars = [
-                avatar for avatar in avatars_data 
-                if avatar.get("avatar_type") == "streaming" or 
-                   avatar.get("name", "").lower() in ["monica", "josh", "anna", "wayne"]
-            ]
-            return streaming_avatars
-        else:
-            st.warning(f"Could not fetch avatars: {response.status_code}")
-            return []
+        return get_avatar_catalog()
+    except requests.HTTPError as e:
+        st.warning(f"Could not fetch avatars: {e.response.status_code}")
+        return []
     except Exception as e:
         st.warning(f"Error fetching avatars: {str(e)}")
         return []
 
-def create_heygen_component(access_token, avatar_id, session_id, avatar_name, voice_id="default", voice_config=None):
-    """Create HeyGen streaming avatar component using REST API approach with enhanced configuration"""
+def _fetch_avatar_ids(path, list_key=None):
+    """Return the set of avatar ids listed by one HeyGen avatar endpoint"""
+    response = heygen_request("GET", path)
+    response.raise_for_status()
+    data = response.json().get("data", {})
+    avatars = data.get(list_key, []) if list_key else data
+    return {avatar.get("avatar_id") for avatar in avatars if avatar.get("avatar_id")}
+
+def _trial_session(avatar_id, voice_id):
+    """Open and immediately stop a streaming session for one avatar/voice pair"""
+    started = time.perf_counter()
+    try:
+        payload = {"avatar_name": avatar_id, "quality": "low", "version": "v2"}
+        if voice_id:
+            payload["voice"] = {"voice_id": voice_id}
+        response = heygen_request("POST", "/v1/streaming.new", json=payload)
+        latency_ms = round((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            return {"ok": False, "status": response.status_code, "latency_ms": latency_ms, "error": response.text[:200]}
+        
+        session_id = (response.json().get("data") or {}).get("session_id")
+        if not session_id:
+            return {"ok": False, "status": response.status_code, "latency_ms": latency_ms, "error": "no session_id in response"}
+    except Exception as e:
+        return {"ok": False, "status": None, "latency_ms": round((time.perf_counter() - started) * 1000), "error": str(e)}
+    
+    # The session is billed until it is stopped, so a failed stop fails the trial
+    result = {"ok": True, "status": response.status_code, "latency_ms": latency_ms, "session_id": session_id}
+    try:
+        stop_response = heygen_request("POST", "/v1/streaming.stop", json={"session_id": session_id})
+        result["stop_status"] = stop_response.status_code
+        if not 200 <= stop_response.status_code < 300:
+            result.update(ok=False, error=f"stop failed, session may still be running: {stop_response.text[:200]}")
+    except Exception as e:
+        result.update(ok=False, stop_status=None, error=f"stop failed, session may still be running: {e}")
+    return result
+
+def run_health_check(trial=False):
+    """Validate every scenario's avatar/voice pair concurrently and write the report to disk"""
+    started = time.perf_counter()
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "trial": trial,
+        "errors": [],
+        "scenarios": [],
+    }
+    
+    # Worker threads share the caller's script context so cached catalog lookups work from them
+    with ThreadPoolExecutor(
+        max_workers=HEALTH_CHECK_WORKERS,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    ) as executor:
+        # Catalog fetches and trial sessions are independent, so they all run at once
+        voices_future = executor.submit(get_voice_index)
+        avatar_futures = {
+            "/v2/avatars": executor.submit(_fetch_avatar_ids, "/v2/avatars", "avatars"),
+            "/v1/streaming/avatar.list": executor.submit(_fetch_avatar_ids, "/v1/streaming/avatar.list"),
+        }
+        trial_futures = {
+            name: executor.submit(_trial_session, config["avatar_id"], config["voice_id"])
+            for name, config in SCENARIOS.items()
+        } if trial else {}
+        
+        voice_index = None
+        try:
+            voice_index = voices_future.result()
+        except Exception as e:
+            report["errors"].append(f"/v2/voices: {e}")
+        
+        avatar_ids = set()
+        for path, future in avatar_futures.items():
+            try:
+                avatar_ids |= future.result()
+            except Exception as e:
+                report["errors"].append(f"{path}: {e}")
+        
+        for name, config in SCENARIOS.items():
+            result = {
+                "scenario": name,
+                "character": config["character"],
+                "avatar_id": config["avatar_id"],
+                "avatar_found": config["avatar_id"] in avatar_ids if avatar_ids else None,
+                "voice_id": config["voice_id"],
+                "voice_found": config["voice_id"] in voice_index.voices if voice_index else None,
+                "voice_streaming": config["voice_id"] in voice_index.streaming if voice_index else None,
+            }
+            if name in trial_futures:
+                result["trial"] = trial_futures[name].result()
+            result["ok"] = (
+                result["avatar_found"] is not False
+                and result["voice_found"] is not False
+                and result["voice_streaming"] is not False
+                and result.get("trial", {}).get("ok", True)
+            )
+            report["scenarios"].append(result)
+    
+    report["ok"] = not report["errors"] and all(result["ok"] for result in report["scenarios"])
+    report["duration_ms"] = round((time.perf_counter() - started) * 1000)
+    
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(HEALTH_REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+def load_health_report():
+    """Read the last cached health report, or None if there isn't one"""
+    try:
+        with open(HEALTH_REPORT_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def show_health_report(report):
+    """Render a health report inside the Debug expander"""
+    status = "✅ All scenarios healthy" if report["ok"] else "⚠️ Problems found"
+    st.markdown(f"**{status}** (checked {report['generated_at']} in {report['duration_ms']} ms)")
+    for error in report["errors"]:
+        st.warning(f"Could not check {error}")
+    
+    rows = []
+    for result in report["scenarios"]:
+        trial_result = result.get("trial")
+        rows.append({
+            "scenario": result["scenario"],
+            "character": result["character"],
+            "avatar_id": result["avatar_id"],
+            "avatar found": result["avatar_found"],
+            "voice_id": result["voice_id"],
+            "voice found": result["voice_found"],
+            "streaming voice": result["voice_streaming"],
+            "trial": None if trial_result is None else ("ok" if trial_result["ok"] else f"failed ({trial_result['status']})"),
+            "trial ms": None if trial_result is None else trial_result["latency_ms"],
+            "stop status": None if trial_result is None else trial_result.get("stop_status"),
+        })
+    st.dataframe(rows, use_container_width=True, hide_index=True)
+
+class StackSampler:
+    """Periodically sample one thread's Python stack from a background thread"""
+    
+    def __init__(self, root_code, interval=PROFILE_SAMPLE_INTERVAL):
+        self.root_code = root_code
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._target = None
+        self._thread = None
+    
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                if code is self.root_code:
+                    break
+                frame = frame.f_back
+            # Only keep samples taken inside the profiled function, root first
+            if frame is not None:
+                self.samples[tuple(reversed(stack))] += 1
+
+def _write_sampled_profile(samples, interval, path_stem):
+    """Save sampled stacks as a speedscope profile and a folded flamegraph file"""
+    frames, frame_index = [], {}
+    speedscope_samples, weights, folded = [], [], []
+    for stack, count in samples.items():
+        indices = []
+        for name, filename, line in stack:
+            if (name, filename, line) not in frame_index:
+                frame_index[(name, filename, line)] = len(frames)
+                frames.append({"name": name, "file": filename, "line": line})
+            indices.append(frame_index[(name, filename, line)])
+        speedscope_samples.append(indices)
+        weights.append(count * interval)
+        folded.append(";".join(f"{name} ({os.path.basename(filename)}:{line})" for name, filename, line in stack) + f" {count}")
+    
+    speedscope = {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "exporter": "streamlit_app.py",
+        "name": os.path.basename(path_stem),
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": os.path.basename(path_stem),
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": speedscope_samples,
+            "weights": weights,
+        }],
+    }
+    with open(f"{path_stem}.speedscope.json", "w") as f:
+        json.dump(speedscope, f)
+    with open(f"{path_stem}.folded", "w") as f:
+        f.write("\n".join(folded) + "\n")
+    return [f"{path_stem}.speedscope.json", f"{path_stem}.folded"]
+
+def _sampled_hot_functions(samples, interval):
+    """Top functions by self time from sampled stacks"""
+    self_counts, total_counts = Counter(), Counter()
+    for stack, count in samples.items():
+        self_counts[stack[-1]] += count
+        for frame in set(stack):
+            total_counts[frame] += count
+    return [
+        {
+            "function": f"{name} ({os.path.basename(filename)}:{line})",
+            "self ms": round(count * interval * 1000, 1),
+            "total ms": round(total_counts[(name, filename, line)] * interval * 1000, 1),
+            "samples": count,
+        }
+        for (name, filename, line), count in self_counts.most_common(PROFILE_TOP_FUNCTIONS)
+    ]
+
+def _cprofile_hot_functions(profiler):
+    """Top functions by own time from a cProfile run"""
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return [
+        {
+            "function": f"{name} ({os.path.basename(filename)}:{line})",
+            "self ms": round(tottime * 1000, 1),
+            "total ms": round(cumtime * 1000, 1),
+            "calls": ncalls,
+        }
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in rows
+    ]
+
+def _prune_profile_dir():
+    """Delete the files of all but the last PROFILE_FILES_KEPT profiled reruns"""
+    by_rerun = defaultdict(list)
+    for name in os.listdir(PROFILE_DIR):
+        # Stems are timestamps, so they sort oldest first
+        by_rerun[name.split(".")[0]].append(name)
+    for stem in sorted(by_rerun)[:-PROFILE_FILES_KEPT]:
+        for name in by_rerun[stem]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except FileNotFoundError:
+                pass
+
+def run_with_profiling(func):
+    """Run one rerun of func, profiling it if the Debug expander asked for it"""
+    reruns_left = st.session_state.get("profile_reruns_left", 0)
+    if not reruns_left:
+        return func()
+    
+    st.session_state["profile_reruns_left"] = reruns_left - 1
+    mode = st.session_state.get("profile_mode", "cProfile")
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path_stem = os.path.join(PROFILE_DIR, f"rerun-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+    
+    started = time.perf_counter()
+    # The sampler always runs, so every profiled rerun gets speedscope and flamegraph files
+    sampler = StackSampler(func.__code__)
+    sampler.start()
+    if mode == "cProfile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        return func()
+    finally:
+        # st.stop() and reruns raise out of func, so results are saved here either way
+        duration_ms = round((time.perf_counter() - started) * 1000)
+        if mode == "cProfile":
+            profiler.disable()
+        sampler.stop()
+        files = _write_sampled_profile(sampler.samples, sampler.interval, path_stem)
+        if mode == "cProfile":
+            profiler.dump_stats(f"{path_stem}.prof")
+            files.insert(0, f"{path_stem}.prof")
+            top = _cprofile_hot_functions(profiler)
+        else:
+            top = _sampled_hot_functions(sampler.samples, sampler.interval)
+        _prune_profile_dir()
+        
+        results = st.session_state.setdefault("profile_results", [])
+        results.insert(0, {"mode": mode, "duration_ms": duration_ms, "top": top, "files": files})
+        del results[PROFILE_HISTORY:]
+
+def profiling_panel():
+    """Debug expander controls for profiling the next N reruns"""
+    st.markdown("**Rerun profiling:**")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        reruns = st.number_input("Reruns to profile:", min_value=1, max_value=50, value=3, key="profile_reruns")
+    with col2:
+        mode = st.selectbox("Profiler:", ["cProfile", "Sampling"], key="profile_mode_choice")
+    with col3:
+        if st.button("Profile next reruns"):
+            st.session_state["profile_reruns_left"] = reruns
+            st.session_state["profile_mode"] = mode
+    
+    reruns_left = st.session_state.get("profile_reruns_left", 0)
+    if reruns_left:
+        st.caption(f"Profiling the next {reruns_left} rerun(s)")
+    
+    for result in st.session_state.get("profile_results", []):
+        st.markdown(f"{result['mode']} rerun, {result['duration_ms']} ms, saved to `{'`, `'.join(result['files'])}`")
+        st.dataframe(result["top"], use_container_width=True, hide_index=True)
+
+# Bidirectional avatar component: HeyGen calls run in the browser, and session events come back to Python
+_heygen_avatar_component = components.declare_component(
+    "heygen_avatar",
+    path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "heygen_avatar")
+)
+
+def _redact(value):
+    """Copy of a recording entry with credential fields replaced, including inside JSON response bodies"""
+    if isinstance(value, dict):
+        redacted = {}
+        for field, item in value.items():
+            if field in RECORDING_REDACTED_FIELDS and item:
+                redacted[field] = RECORDING_REDACTED
+            elif field == "body" and isinstance(item, str):
+                try:
+                    redacted[field] = json.dumps(_redact(json.loads(item)))
+                except ValueError:
+                    redacted[field] = item
+            else:
+                redacted[field] = _redact(item)
+        return redacted
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+class SessionRecorder:
+    """Timed JSONL log of one browser session: reruns, avatar component events and HeyGen traffic"""
+    
+    def __init__(self, client_id):
+        os.makedirs(RECORDING_DIR, exist_ok=True)
+        self.path = os.path.join(RECORDING_DIR, f"{client_id}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl")
+        self.started = time.time()
+        self.in_page_rerun = False
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a")
+        self.record("start", client_id=client_id, api_base=HEYGEN_API_BASE)
+        # Catalogs are fetched once per process, so most sessions never call them; a replay still needs them
+        for response in list(get_catalog_responses().values()):
+            self.record("http", source="server", cached=True, json=None, **response)
+    
+    def record(self, kind, t=None, **fields):
+        entry = {"t": round((t or time.time()) - self.started, 4), "kind": kind, **_redact(fields)}
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + "\n")
+                self._file.flush()
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+    
+    def snapshot_state(self):
+        """JSON-serializable session state (widget values, component values), minus app internals"""
+        state = {}
+        for key, value in st.session_state.items():
+            if key in RECORDING_SKIPPED_KEYS or key.startswith("$$") or key.endswith("_events_seen"):
+                continue
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            state[key] = value
+        return state
+
+def get_recorder():
+    """The recorder for the current browser session, or None when it isn't being recorded"""
+    if get_script_run_ctx() is None:
+        return None
+    if RECORD_ALL_SESSIONS and "recorder" not in st.session_state:
+        st.session_state["recorder"] = SessionRecorder(get_client_id())
+    return st.session_state.get("recorder")
+
+@contextmanager
+def recorded_rerun(scope):
+    """Record a rerun's widget state and duration; scope is "page" or the scenario of a fragment rerun"""
+    recorder = get_recorder()
+    # A fragment that runs as part of a full page rerun is already covered by the page entry
+    if recorder is None or (scope != "page" and recorder.in_page_rerun):
+        yield
+        return
+    
+    state = recorder.snapshot_state()
+    started = time.time()
+    recorder.in_page_rerun = scope == "page"
+    try:
+        yield
+    finally:
+        recorder.in_page_rerun = False
+        recorder.record("rerun", t=started, scope=scope, state=state, duration_ms=round((time.time() - started) * 1000))
+
+def recording_panel():
+    """Debug expander controls for recording this session for later replay"""
+    st.markdown("**Session recording:**")
+    recorder = st.session_state.get("recorder")
+    if recorder is None:
+        if st.button("⏺ Start recording"):
+            st.session_state["recorder"] = SessionRecorder(get_client_id())
+            st.rerun()
+    else:
+        st.caption(f"Recording to `{recorder.path}`. Replay with `python streamlit_app.py --replay {recorder.path}`")
+        if st.button("⏹ Stop recording"):
+            recorder.close()
+            del st.session_state["recorder"]
+            st.rerun()
+
+class HeyGenStub:
+    """Local stand-in for the HeyGen API that answers the app's server-side calls with a recording's responses
+    
+    Responses are served at their recorded latency divided by speed. Recorded tokens are placeholders, which
+    the stub doesn't check.
+    """
+    
+    def __init__(self, entries, speed=1.0):
+        self.speed = speed
+        self.unrecorded = []  # requests the recording had no response for
+        self._lock = threading.Lock()
+        self._responses = defaultdict(deque)
+        self._last = {}
+        for entry in entries:
+            if entry["kind"] == "http" and entry["source"] == "server":
+                self._responses[(entry["method"], entry["path"])].append(entry)
+        
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                path = self.path.split("?")[0]
+                entry = stub.next_response(self.command, path)
+                if entry is None and path not in REPLAY_BACKGROUND_PATHS:
+                    stub.unrecorded.append(f"{self.command} {path}")
+                    status, body = 404, json.dumps({"error": "not in recording"})
+                else:
+                    time.sleep(entry["latency_ms"] / 1000 / stub.speed)
+                    status, body = entry["status"], entry["body"] or ""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body.encode())
+            
+            do_GET = do_POST = _reply
+            
+            def log_message(self, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+    
+    def next_response(self, method, path):
+        """Recorded responses are served in order; once used up, the last one repeats"""
+        with self._lock:
+            queue = self._responses.get((method, path))
+            if queue:
+                self._last[(method, path)] = queue.popleft()
+            return self._last.get((method, path))
+    
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def stop(self):
+        self.server.shutdown()
+
+def replay_recording(path, speed=1.0):
+    """Drive the app through a recorded session against the local stub and compare latencies"""
+    # Only needed for replays, and heavier than the rest of the app's imports
+    from streamlit.testing.v1 import AppTest
+    
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    entries.sort(key=lambda entry: entry["t"])
+    component_keys = {entry["key"] for entry in entries if entry["kind"] == "component_events"}
+    
+    stub = HeyGenStub(entries, speed)
+    stub.start()
+    # The app is re-executed by AppTest in this process, so it picks these up at import
+    os.environ["HEYGEN_API_BASE"] = stub.url
+    # The replayed app records itself to a scratch directory, so its reruns are timed exactly like the
+    # recorded ones, without AppTest's own overhead
+    replay_dir = tempfile.mkdtemp(prefix="heygen-replay-")
+    os.environ["HEYGEN_RECORD_SESSIONS"] = "1"
+    os.environ["HEYGEN_RECORDING_DIR"] = replay_dir
+    if not HEYGEN_API_KEYS:
+        os.environ["HEYGEN_API_KEYS"] = "replay-key"
+    
+    if any(entry.get("cached") for entry in entries):
+        # The recorded session found the catalogs already cached; an untimed run warms the same
+        # process-wide caches here so the first replayed rerun doesn't pay for fetching them
+        AppTest.from_file(os.path.abspath(__file__), default_timeout=60).run()
+    
+    app = AppTest.from_file(os.path.abspath(__file__), default_timeout=60)
+    replay_log = None
+    steps = []
+    exceptions = []
+    started = time.time()
+    try:
+        for entry in entries:
+            delay = started + entry["t"] / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            
+            if entry["kind"] == "rerun":
+                widgets = {}
+                for widget_type in ("selectbox", "text_input", "number_input", "checkbox"):
+                    for widget in getattr(app, widget_type):
+                        if widget.key:
+                            widgets[widget.key] = widget
+                for key, value in entry["state"].items():
+                    if key in widgets:
+                        widgets[key].set_value(value)
+                    elif key in component_keys:
+                        app.session_state[key] = value
+                
+                # AppTest has no fragment-only reruns, so fragment entries replay as full reruns
+                app.run()
+                if replay_log is None and "recorder" in app.session_state:
+                    replay_log = open(app.session_state["recorder"].path)
+                replayed = [json.loads(line) for line in replay_log] if replay_log else []
+                replay_ms = next((e["duration_ms"] for e in reversed(replayed) if e["kind"] == "rerun"), None)
+                step = {
+                    "step": f"rerun ({entry['scope']})",
+                    "at_s": entry["t"],
+                    "original_ms": entry["duration_ms"],
+                    "replay_ms": replay_ms,
+                }
+                # At other speeds the stub's scaled latency makes every rerun look faster, so there's no fair baseline
+                if speed == 1 and replay_ms is not None:
+                    step["delta_ms"] = replay_ms - entry["duration_ms"]
+                steps.append(step)
+                # Each run replaces the element tree, so exceptions are collected run by run
+                exceptions.extend(f"{step['step']} at {entry['t']:.2f}s: {exception.message}" for exception in app.exception)
+            # Browser-side HeyGen calls happen in the avatar component, which AppTest doesn't run, so they aren't replayed
+    finally:
+        stub.stop()
+        if replay_log:
+            replay_log.close()
+        shutil.rmtree(replay_dir, ignore_errors=True)
+    
+    report = {
+        "recording": path,
+        "speed": speed,
+        "replayed_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "exceptions": exceptions,
+        # The app took a different path than in the recording, so its timings don't compare
+        "unrecorded_requests": sorted(set(stub.unrecorded)),
+        "steps": steps,
+    }
+    report_path = f"{os.path.splitext(path)[0]}.replay.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    report["path"] = report_path
+    return report
+
+@st.cache_resource
+def get_session_broker():
+    """Process-wide live avatar sessions by resume token, so a reloaded page can find what it left running"""
+    return {}
+
+def _expire_broker(broker):
+    cutoff = time.time() - SESSION_IDLE_SECONDS
+    for token, saved in list(broker.items()):
+        if saved["touched"] < cutoff:
+            broker.pop(token, None)
+
+def restore_live_sessions():
+    """Pick up avatars this browser left running before a reload, using the resume cookie set by the avatar component"""
+    broker = get_session_broker()
+    token = st.session_state.get("resume_token")
+    if token is None:
+        # The token is a browser cookie rather than part of the URL, so a shared link can't take over a
+        # student's avatar, and each token is claimed once and replaced by a new one
+        saved = broker.pop(st.context.cookies.get(RESUME_COOKIE), None)
+        if saved:
+            st.session_state.update(client_id=saved["client_id"], live_sessions=saved["live_sessions"])
+        token = st.session_state["resume_token"] = uuid.uuid4().hex
+    
+    saved = broker.get(token)
+    if saved is None:
+        _expire_broker(broker)
+        # The live sessions dict is shared with the broker, so the next reload sees this session's updates
+        saved = broker[token] = {
+            "client_id": get_client_id(),
+            "live_sessions": st.session_state.setdefault("live_sessions", {}),
+            "touched": time.time(),
+        }
+    saved["touched"] = time.time()
+
+def resume_cookie():
+    """Cookie the avatar component stores so a reload of this browser can find its live sessions"""
+    if "resume_token" not in st.session_state:
+        return None
+    return f"{RESUME_COOKIE}={st.session_state['resume_token']}; Path=/; Max-Age={SESSION_IDLE_SECONDS}; SameSite=Strict"
+
+def _stop_stale_session(live):
+    try:
+        requests.post(
+            f"{HEYGEN_API_BASE}/v1/streaming.stop",
+            headers={"Authorization": f"Bearer {live['access_token']}", "Content-Type": "application/json"},
+            json={"session_id": live["session_id"]},
+            timeout=10
+        )
+    except requests.RequestException:
+        pass
+
+def heygen_avatar(access_token, avatar_id, session_id, avatar_name, voice_id="default", voice_config=None):
+    """Render a HeyGen streaming avatar component and return the events it reported since the last rerun"""
     
     # Default voice configuration based on SDK patterns
     if voice_config is None:
@@ -105,485 +1507,395 @@ def create_heygen_component(access_token, avatar_id, session_id, avatar_name, vo
             "emotion": "friendly"
         }
     
-    # Use a safe default voice if the provided one might not work
-    safe_voice_id = voice_id if voice_id != "default" else None
-    
-    # This creates a pure HTML/JS implementation that uses the HeyGen REST API
-    # with enhanced session management and token refresh capability
-    component_html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            body {{
-                margin: 0;
-                padding: 20px;
-                background: #1a1a1a;
-                color: white;
-                font-family: -apple-system, BlinkMacSystemFont, sans-serif;
-            }}
-            
-            .container {{
-                max-width: 800px;
-                margin: 0 auto;
-            }}
-            
-            .avatar-section {{
-                background: #2d2d2d;
-                border-radius: 12px;
-                padding: 20px;
-                margin-bottom: 20px;
-            }}
-            
-            .avatar-video {{
-                width: 100%;
-                height: 400px;
-                background: black;
-                border-radius: 8px;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                margin-bottom: 15px;
-                position: relative;
-            }}
-            
-            .video-element {{
-                width: 100%;
-                height: 100%;
-                object-fit: cover;
-                border-radius: 8px;
-            }}
-            
-            .status {{
-                text-align: center;
-                padding: 10px;
-                border-radius: 6px;
-                margin-bottom: 15px;
-                font-weight: 500;
-            }}
-            
-            .status.loading {{ background: #1f4e79; color: #87ceeb; }}
-            .status.success {{ background: #1f4e3b; color: #90ee90; }}
-            .status.error {{ background: #4e1f1f; color: #ffcccb; }}
-            
-            .controls {{
-                display: grid;
-                grid-template-columns: repeat(auto-fit, minmax(120px, 1fr));
-                gap: 10px;
-                margin-bottom: 20px;
-            }}
-            
-            button {{
-                background: #0066cc;
-                color: white;
-                border: none;
-                padding: 12px 16px;
-                border-radius: 6px;
-                cursor: pointer;
-                font-weight: 500;
-                transition: all 0.2s;
-            }}
-            
-            button:hover {{
-                background: #0052a3;
-                transform: translateY(-1px);
-            }}
-            
-            button:disabled {{
-                background: #555;
-                cursor: not-allowed;
-                transform: none;
-            }}
-            
-            .chat-input {{
-                display: flex;
-                gap: 10px;
-                margin-bottom: 15px;
-            }}
-            
-            input[type="text"] {{
-                flex: 1;
-                padding: 12px;
-                border: 1px solid #555;
-                border-radius: 6px;
-                background: #333;
-                color: white;
-            }}
-            
-            .log {{
-                background: #1a1a1a;
-                border: 1px solid #333;
-                border-radius: 6px;
-                padding: 15px;
-                height: 150px;
-                overflow-y: auto;
-                font-family: 'Monaco', 'Menlo', monospace;
-                font-size: 12px;
-                line-height: 1.4;
-            }}
-            
-            .log-entry {{
-                margin-bottom: 5px;
-                padding: 2px 0;
-            }}
-            
-            .log-timestamp {{
-                color: #888;
-                margin-right: 8px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="avatar-section">
-                <h3>{avatar_name} - Interactive Session</h3>
-                
-                <div class="avatar-video" id="avatarVideo">
-                    <video id="videoElement" class="video-element" autoplay muted style="display: none;"></video>
-                    <div id="placeholderText" style="color: #666; font-size: 18px;">
-                        Setting up {avatar_name}...
-                    </div>
-                </div>
-                
-                <div id="status" class="status loading">Initializing session...</div>
-                
-                <div class="controls">
-                    <button id="startBtn" onclick="startSession()">Start Session</button>
-                    <button id="speakBtn" onclick="speakText()" disabled>Speak Test</button>
-                    <button id="stopBtn" onclick="stopSession()" disabled>Stop Session</button>
-                </div>
-                
-                <div class="chat-input">
-                    <input type="text" id="chatInput" placeholder="Enter message for avatar to speak..." 
-                           disabled onkeypress="handleKeyPress(event)">
-                    <button onclick="speakCustomText()" disabled id="sendBtn">Send</button>
-                </div>
-                
-                <div class="log" id="logArea"></div>
-            </div>
-        </div>
-
-        <script>
-            // Session state
-            let sessionData = null;
-            let isConnected = false;
-            
-            // DOM elements
-            const statusEl = document.getElementById('status');
-            const startBtn = document.getElementById('startBtn');
-            const speakBtn = document.getElementById('speakBtn');
-            const stopBtn = document.getElementById('stopBtn');
-            const chatInput = document.getElementById('chatInput');
-            const sendBtn = document.getElementById('sendBtn');
-            const logArea = document.getElementById('logArea');
-            const videoElement = document.getElementById('videoElement');
-            const placeholderText = document.getElementById('placeholderText');
-            
-            function log(message, type = 'info') {{
-                const timestamp = new Date().toLocaleTimeString();
-                const logEntry = document.createElement('div');
-                logEntry.className = 'log-entry';
-                logEntry.innerHTML = `<span class="log-timestamp">${{timestamp}}</span>${{message}}`;
-                logArea.appendChild(logEntry);
-                logArea.scrollTop = logArea.scrollHeight;
-                console.log(`[${{type.toUpperCase()}}] ${{message}}`);
-            }}
-            
-            function updateStatus(message, type = 'loading') {{
-                statusEl.textContent = message;
-                statusEl.className = `status ${{type}}`;
-                log(message);
-            }}
-            
-            async function startSession() {{
-                try {{
-                    updateStatus('Creating avatar session...', 'loading');
-                    startBtn.disabled = true;
-                    
-                    // Try with voice first, then fallback to no voice
-                    let requestPayload;
-                    
-                    const basePayload = {{
-                        avatar_name: '{avatar_id}',
-                        quality: 'low',
-                        version: 'v2'
-                    }};
-                    
-                    // Only add voice if we have a specific voice ID
-                    if ('{safe_voice_id}' && '{safe_voice_id}' !== 'None') {{
-                        requestPayload = {{
-                            ...basePayload,
-                            voice: {{
-                                voice_id: '{safe_voice_id}',
-                                rate: {voice_config.get("rate", 1.0)}
-                            }}
-                        }};
-                    }} else {{
-                        requestPayload = basePayload;
-                    }}
-                    
-                    log(`Request payload: ${{JSON.stringify(requestPayload, null, 2)}}`);
-                    
-                    let response = await fetch('https://api.heygen.com/v1/streaming.new', {{
-                        method: 'POST',
-                        headers: {{
-                            'Authorization': 'Bearer {access_token}',
-                            'Content-Type': 'application/json'
-                        }},
-                        body: JSON.stringify(requestPayload)
-                    }});
-                    
-                    log(`Response status: ${{response.status}}`);
-                    
-                    // If unauthorized, the token might have expired - show error and suggest refresh
-                    if (response.status === 401) {{
-                        const errorText = await response.text();
-                        log(`Auth error: ${{errorText}}`);
-                        updateStatus('Authentication failed - please refresh the page', 'error');
-                        startBtn.disabled = false;
-                        return;
-                    }}
-                    
-                    // If voice not supported, try without voice
-                    if (!response.ok) {{
-                        const errorText = await response.text();
-                        log(`Error response: ${{errorText}}`);
-                        
-                        if (errorText.includes('voice_not_support')) {{
-                            log('Voice not supported, trying without voice...');
-                            const noVoicePayload = {{
-                                avatar_name: '{avatar_id}',
-                                quality: 'low',
-                                version: 'v2'
-                            }};
-                            
-                            response = await fetch('https://api.heygen.com/v1/streaming.new', {{
-                                method: 'POST',
-                                headers: {{
-                                    'Authorization': 'Bearer {access_token}',
-                                    'Content-Type': 'application/json'
-                                }},
-                                body: JSON.stringify(noVoicePayload)
-                            }});
-                            
-                            if (!response.ok) {{
-                                const retryError = await response.text();
-                                throw new Error(`Session creation failed: ${{response.status}} - ${{retryError}}`);
-                            }}
-                        }} else {{
-                            throw new Error(`Session creation failed: ${{response.status}} - ${{errorText}}`);
-                        }}
-                    }}
-                    
-                    const data = await response.json();
-                    sessionData = data.data;
-                    
-                    log(`Session created: ${{sessionData.session_id}}`);
-                    
-                    // Start the session
-                    const startResponse = await fetch('https://api.heygen.com/v1/streaming.start', {{
-                        method: 'POST',
-                        headers: {{
-                            'Authorization': 'Bearer {access_token}',
-                            'Content-Type': 'application/json'
-                        }},
-                        body: JSON.stringify({{
-                            session_id: sessionData.session_id
-                        }})
-                    }});
-                    
-                    if (!startResponse.ok) {{
-                        throw new Error(`Session start failed: ${{startResponse.status}}`);
-                    }}
-                    
-                    updateStatus('Session started successfully!', 'success');
-                    isConnected = true;
-                    
-                    // Enable controls
-                    speakBtn.disabled = false;
-                    stopBtn.disabled = false;
-                    chatInput.disabled = false;
-                    sendBtn.disabled = false;
-                    
-                    // Hide placeholder, show video area
-                    placeholderText.style.display = 'none';
-                    videoElement.style.display = 'block';
-                    
-                    log('Avatar is ready for interaction');
-                    
-                }} catch (error) {{
-                    updateStatus(`Error: ${{error.message}}`, 'error');
-                    startBtn.disabled = false;
-                    log(`Error: ${{error.message}}`, 'error');
-                    
-                    // Try fallback with minimal parameters
-                    if (error.message.includes('400')) {{
-                        log('Attempting fallback with minimal parameters...');
-                        try {{
-                            const fallbackPayload = {{
-                                avatar_name: '{avatar_id}',
-                                quality: 'low'
-                            }};
-                            
-                            log(`Fallback payload: ${{JSON.stringify(fallbackPayload, null, 2)}}`);
-                            
-                            const fallbackResponse = await fetch('https://api.heygen.com/v1/streaming.new', {{
-                                method: 'POST',
-                                headers: {{
-                                    'Authorization': 'Bearer {access_token}',
-                                    'Content-Type': 'application/json'
-                                }},
-                                body: JSON.stringify(fallbackPayload)
-                            }});
-                            
-                            if (fallbackResponse.ok) {{
-                                const data = await fallbackResponse.json();
-                                sessionData = data.data;
-                                log(`Fallback session created: ${{sessionData.session_id}}`);
-                                updateStatus('Session created with fallback parameters', 'success');
-                                
-                                // Continue with session start
-                                const startResponse = await fetch('https://api.heygen.com/v1/streaming.start', {{
-                                    method: 'POST',
-                                    headers: {{
-                                        'Authorization': 'Bearer {access_token}',
-                                        'Content-Type': 'application/json'
-                                    }},
-                                    body: JSON.stringify({{
-                                        session_id: sessionData.session_id
-                                    }})
-                                }});
-                                
-                                if (startResponse.ok) {{
-                                    updateStatus('Session started successfully!', 'success');
-                                    isConnected = true;
-                                    speakBtn.disabled = false;
-                                    stopBtn.disabled = false;
-                                    chatInput.disabled = false;
-                                    sendBtn.disabled = false;
-                                    placeholderText.style.display = 'none';
-                                    videoElement.style.display = 'block';
-                                    log('Avatar is ready for interaction');
-                                }} else {{
-                                    const startError = await startResponse.text();
-                                    throw new Error(`Fallback session start failed: ${{startResponse.status}} - ${{startError}}`);
-                                }}
-                            }} else {{
-                                const fallbackError = await fallbackResponse.text();
-                                log(`Fallback also failed: ${{fallbackResponse.status}} - ${{fallbackError}}`);
-                                updateStatus('Both primary and fallback attempts failed', 'error');
-                            }}
-                        }} catch (fallbackError) {{
-                            log(`Fallback error: ${{fallbackError.message}}`, 'error');
-                            updateStatus('All session creation attempts failed', 'error');
-                        }}
-                    }}
-                }}
-            }}
+    # A running session keeps the token that created it. A newly mounted component (page reload, or back
+    # from text-only mode) reattaches to it if it was heard from within the grace window; a mounted one
+    # ignores the offer.
+    live_sessions = st.session_state.setdefault("live_sessions", {})
+    live = live_sessions.get(session_id)
+    if live:
+        access_token = live["access_token"]
+    resumable = live and time.time() - live["last_seen"] <= RESUME_GRACE_SECONDS
+    
+    recorder = get_recorder()
+    value = _heygen_avatar_component(
+        access_token=access_token,
+        api_base=HEYGEN_API_BASE,
+        avatar_id=avatar_id,
+        avatar_name=avatar_name,
+        # Use a safe default voice if the provided one might not work
+        voice_id=voice_id if voice_id != "default" else None,
+        voice_rate=voice_config.get("rate", 1.0),
+        # While recording, the component also reports its own HeyGen requests and responses
+        record_http=recorder is not None,
+        keep_alive_seconds=KEEP_ALIVE_SECONDS,
+        resume={"session_id": live["session_id"], "session_data": live["session_data"]} if resumable else None,
+        resume_cookie=resume_cookie(),
+        key=session_id,
+        default=None
+    )
+    if not value:
+        return []
+    
+    # The component resends a window of recent events; only hand back the ones not seen yet.
+    # A re-mounted component starts a new instance with its own sequence numbers.
+    seen_key = f"{session_id}_events_seen"
+    instance, last_seq = st.session_state.get(seen_key, (None, 0))
+    if value["instance"] != instance:
+        last_seq = 0
+    events = [event for event in value["events"] if event["seq"] > last_seq]
+    if events:
+        st.session_state[seen_key] = (value["instance"], events[-1]["seq"])
+        if recorder:
+            recorder.record("component_events", key=session_id, events=events)
+            for event in events:
+                if event["type"] == "http":
+                    recorder.record(
+                        "http",
+                        t=event["t"] - event["latency_ms"] / 1000,
+                        source="browser",
+                        **{field: event.get(field) for field in ("method", "path", "json", "status", "latency_ms", "body")}
+                    )
+    
+    for event in events:
+        live = live_sessions.get(session_id)
+        if event["type"] == "session_started":
+            live_sessions[session_id] = {
+                "session_id": event["session_id"],
+                "session_data": event["session_data"],
+                "access_token": access_token,
+                "instance": value["instance"],
+                "last_seen": time.time(),
+            }
+        elif event["type"] == "session_resumed" and live:
+            live["instance"] = value["instance"]
+        elif event["type"] in ("session_stopped", "resume_failed"):
+            live_sessions.pop(session_id, None)
+        elif event["type"] == "mounted" and live and live["instance"] != value["instance"]:
+            # The component came back after the grace window and wasn't offered its session, so nothing
+            # will reattach to it; stop it rather than leave it billing until HeyGen idles it out
+            del live_sessions[session_id]
+            threading.Thread(target=_stop_stale_session, args=(live,), daemon=True).start()
+    
+    # Any event from the component that owns the session shows it is still mounted and in use
+    live = live_sessions.get(session_id)
+    if events and live and live["instance"] == value["instance"]:
+        live["last_seen"] = time.time()
+    return events
+
+class SessionRegistry:
+    """Live state of every student session, with a change log so dashboards only redraw what changed"""
+    
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._sessions = {}
+        self._last_seen = {}
+        self._log = deque(maxlen=REGISTRY_CHANGE_LOG)
+        self.version = 0
+    
+    def _row(self, client_id):
+        if client_id not in self._sessions:
+            self._sessions[client_id] = {
+                "student": client_id,
+                "phase": "waiting",
+                "avatar": None,
+                "speaking": None,
+                "token ms": None,
+                "start ms": None,
+                "speak ms": None,
+                "reconnect ms": None,
+                "errors": 0,
+                "last change": None,
+            }
+        self._last_seen[client_id] = time.time()
+        return self._sessions[client_id]
+    
+    def _errors(self, client_id):
+        return self._sessions[client_id]["errors"] if client_id in self._sessions else 0
+    
+    def _apply(self, client_id, changes):
+        is_new = client_id not in self._sessions
+        row = self._row(client_id)
+        changes = {field: value for field, value in changes.items() if row.get(field) != value}
+        if not changes and not is_new:
+            return
+        row.update(changes, **{"last change": datetime.now().strftime("%H:%M:%S")})
+        self.version += 1
+        self._log.append((self.version, client_id))
+        self._changed.notify_all()
+    
+    def update(self, client_id, **fields):
+        """Merge fields into a student's row; unchanged values don't wake dashboards"""
+        with self._changed:
+            self._apply(client_id, fields)
+    
+    def record_error(self, client_id):
+        with self._changed:
+            self._apply(client_id, {"errors": self._errors(client_id) + 1})
+    
+    def apply_events(self, client_id, scenario, character, events):
+        """Fold avatar component events into the student's row"""
+        with self._changed:
+            changes = {}
+            for event in events:
+                kind = event["type"]
+                if kind == "session_starting":
+                    changes.update({"phase": scenario, "avatar": f"{character}: starting"})
+                elif kind == "session_started":
+                    changes.update({"phase": scenario, "avatar": f"{character}: live", "start ms": event.get("latency_ms")})
+                elif kind == "session_resumed":
+                    changes.update({"phase": scenario, "avatar": f"{character}: live", "reconnect ms": event.get("reconnect_ms")})
+                elif kind == "resume_failed":
+                    changes["avatar"] = f"{character}: expired"
+                elif kind == "session_stopped":
+                    changes.update({"avatar": f"{character}: stopped", "speaking": None})
+                elif kind == "speaking_started":
+                    changes.update({"speaking": character, "speak ms": event.get("latency_ms")})
+                elif kind == "speaking_stopped":
+                    changes["speaking"] = None
+                elif kind in ("session_failed", "error"):
+                    changes["errors"] = changes.get("errors", self._errors(client_id)) + 1
+                    if kind == "session_failed":
+                        changes["avatar"] = f"{character}: failed"
+            self._apply(client_id, changes)
+    
+    def expire_idle(self):
+        """Drop students that have been inactive for SESSION_IDLE_SECONDS"""
+        cutoff = time.time() - SESSION_IDLE_SECONDS
+        with self._changed:
+            expired = [cid for cid, seen in self._last_seen.items() if seen < cutoff]
+            for client_id in expired:
+                del self._sessions[client_id]
+                del self._last_seen[client_id]
+                self.version += 1
+                self._log.append((self.version, client_id))
+            if expired:
+                self._changed.notify_all()
+    
+    def snapshot(self):
+        """Current version and a copy of every row, for a full redraw"""
+        with self._changed:
+            return self.version, {cid: dict(row) for cid, row in self._sessions.items()}
+    
+    def changes_since(self, version, timeout):
+        """Wait up to timeout for changes after version.
+        
+        Returns the new version and {client_id: row, or None if removed}. The dict is None
+        when the change log no longer reaches back to version and the caller must redraw.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version > version, timeout)
+            if self.version == version:
+                return version, {}
+            if self._log[0][0] > version + 1:
+                return self.version, None
             
-            async function speakText(text = "Hello! I'm {avatar_name}, ready for our simulation today.") {{
-                if (!sessionData || !isConnected) {{
-                    updateStatus('Session not active', 'error');
-                    return;
-                }}
-                
-                try {{
-                    updateStatus('Avatar speaking...', 'loading');
-                    
-                    const response = await fetch('https://api.heygen.com/v1/streaming.task', {{
-                        method: 'POST',
-                        headers: {{
-                            'Authorization': 'Bearer {access_token}',
-                            'Content-Type': 'application/json'
-                        }},
-                        body: JSON.stringify({{
-                            session_id: sessionData.session_id,
-                            text: text,
-                            task_type: 'talk'
-                        }})
-                    }});
-                    
-                    if (!response.ok) {{
-                        throw new Error(`Speak request failed: ${{response.status}}`);
-                    }}
-                    
-                    const result = await response.json();
-                    log(`Speaking: "${{text}}"`);
-                    updateStatus('Avatar ready', 'success');
-                    
-                }} catch (error) {{
-                    updateStatus(`Speak error: ${{error.message}}`, 'error');
-                    log(`Speak error: ${{error.message}}`, 'error');
-                }}
-            }}
+            changed = set()
+            for logged_version, client_id in reversed(self._log):
+                if logged_version <= version:
+                    break
+                changed.add(client_id)
+            return self.version, {
+                cid: dict(self._sessions[cid]) if cid in self._sessions else None
+                for cid in changed
+            }
+
+@st.cache_resource
+def get_session_registry():
+    """Process-wide registry shared by student sessions and instructor dashboards"""
+    return SessionRegistry()
+
+def get_client_id():
+    """Short random id for this browser session, shown on the instructor dashboard"""
+    return st.session_state.setdefault("client_id", uuid.uuid4().hex[:8])
+
+DASHBOARD_COLUMNS = ["student", "phase", "avatar", "speaking", "token ms", "start ms", "speak ms", "reconnect ms", "errors", "last change"]
+
+def _draw_dashboard_row(placeholder, row):
+    with placeholder.container():
+        for col, field in zip(st.columns(len(DASHBOARD_COLUMNS)), DASHBOARD_COLUMNS):
+            value = row.get(field)
+            if field == "speaking":
+                value = f"🗣️ {value}" if value else "-"
+            elif field == "errors" and value:
+                value = f"⚠️ {value}"
+            col.markdown("-" if value is None else str(value))
+
+def _draw_dashboard_summary(placeholder, rows):
+    with placeholder.container():
+        cols = st.columns(4)
+        cols[0].metric("Active students", len(rows))
+        cols[1].metric("Live avatars", sum(1 for row in rows.values() if (row["avatar"] or "").endswith("live")))
+        cols[2].metric("Speaking now", sum(1 for row in rows.values() if row["speaking"]))
+        cols[3].metric("Errors", sum(row["errors"] for row in rows.values()))
+
+def passcode_entered(label):
+    """Whether INSTRUCTOR_PASSCODE is unset or has been typed into a password field with this label"""
+    passcode = _read_secret("INSTRUCTOR_PASSCODE") or os.getenv("INSTRUCTOR_PASSCODE")
+    return not passcode or st.text_input(label, type="password") == passcode
+
+def render_instructor_dashboard():
+    """Live cohort view for instructors, opened with ?view=instructor"""
+    st.title("📊 Instructor Cohort Dashboard")
+    
+    if not passcode_entered("Instructor passcode:"):
+        st.info("Enter the instructor passcode to view the cohort.")
+        return
+    
+    registry = get_session_registry()
+    summary = st.empty()
+    heartbeat = st.empty()
+    for col, field in zip(st.columns(len(DASHBOARD_COLUMNS)), DASHBOARD_COLUMNS):
+        col.markdown(f"**{field}**")
+    table = st.container()
+    
+    # One placeholder per student: after the first draw, only rows that changed are re-sent
+    placeholders = {}
+    version, rows = registry.snapshot()
+    changes = dict(rows)
+    
+    while True:
+        if changes is None:
+            # Fell behind the change log: clear everything and redraw from a snapshot
+            for placeholder in placeholders.values():
+                placeholder.empty()
+            placeholders = {}
+            version, rows = registry.snapshot()
+            changes = dict(rows)
+        
+        for client_id, row in changes.items():
+            if row is None:
+                rows.pop(client_id, None)
+                if client_id in placeholders:
+                    placeholders.pop(client_id).empty()
+                continue
+            rows[client_id] = row
+            if client_id not in placeholders:
+                with table:
+                    placeholders[client_id] = st.empty()
+            _draw_dashboard_row(placeholders[client_id], row)
+        
+        if changes:
+            _draw_dashboard_summary(summary, rows)
+        heartbeat.caption(f"Live · {len(rows)} students · checked {datetime.now().strftime('%H:%M:%S')}")
+        
+        registry.expire_idle()
+        version, changes = registry.changes_since(version, DASHBOARD_HEARTBEAT_SECONDS)
+
+@st.fragment
+def character_panel(scenario, avatar_options, voice_index, access_token):
+    """Avatar and voice settings plus the live avatar for one character.
+    
+    Runs as a fragment, so changing a setting here only reruns this panel, not the whole page.
+    """
+    with recorded_rerun(scenario):
+        _character_panel_body(scenario, avatar_options, voice_index, access_token)
+
+def _character_panel_body(scenario, avatar_options, voice_index, access_token):
+    config = SCENARIOS[scenario]
+    prefix = config["key_prefix"]
+    voice_styles = config["voice_styles"]
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        # Filter to show only this character's avatar
+        character_avatars = {k: v for k, v in avatar_options.items() if config["character"] in k}
+        if not character_avatars:
+            # Fallback if the specific avatar isn't found
+            character_avatars = {f"{config['character']} ({config['avatar_id']})": {"id": config["avatar_id"], "voice_id": None}}
+        
+        selected_avatar = st.selectbox(
+            f"Choose Avatar for {config['character'].split()[0]}:",
+            options=list(character_avatars.keys()),
+            key=f"{prefix}_avatar"
+        )
+        # Thumbnails come from the local preview cache, never from HeyGen while the page renders
+        preview = get_avatar_previews().preview(character_avatars[selected_avatar]["id"]) if selected_avatar else None
+        if preview:
+            st.markdown(f"![{preview['avatar_name'] or selected_avatar}]({preview['url']})")
+            details = [value for value in (preview["avatar_name"], preview["gender"]) if value]
+            if details:
+                st.caption(" · ".join(details))
+    with col2:
+        # Voice selection from compatible voices
+        if voice_index:
+            selected_voice_style = None
+            selected_voice_id = voice_picker(prefix, voice_index, config["voice_id"])
+        else:
+            selected_voice_style = st.selectbox(
+                "Voice Style:",
+                options=list(voice_styles.keys()),
+                key=f"{prefix}_voice"
+            )
+            selected_voice_id = config["voice_id"]
+    
+    if selected_avatar and selected_avatar in character_avatars:
+        avatar_config = character_avatars[selected_avatar]
+        voice_config = voice_styles.get(selected_voice_style, next(iter(voice_styles.values())))
+        
+        # Create HeyGen component with compatible voice. The token is memoized per session and the
+        # component is keyed, so a rerun hands a running avatar the same args instead of replacing it.
+        events = heygen_avatar(
+            access_token=access_token,
+            avatar_id=avatar_config["id"],
+            session_id=f"{prefix}_session",
+            avatar_name=config["character"],
+            voice_id=selected_voice_id or "default",
+            voice_config=voice_config
+        )
+        get_session_registry().apply_events(get_client_id(), scenario, config["character"], events)
+
+@st.fragment(run_every=BREAKER_PROBE_INTERVAL_SECONDS)
+def watch_for_recovery():
+    """While in text-only mode, rerun the page as soon as the token endpoint's breaker closes"""
+    if heygen_available():
+        st.rerun()
+
+def render_text_only_mode():
+    """Degraded mode while HeyGen is slow or down: scenario text and a scripted dialogue, no HeyGen calls"""
+    get_session_registry().update(get_client_id(), phase="text-only", avatar=None, speaking=None)
+    st.warning(
+        "⚠️ HeyGen avatars are slow or unavailable right now, so the simulation is running in text-only mode. "
+        "Avatars come back automatically once HeyGen recovers."
+    )
+    if st.button("Check again"):
+        st.rerun()
+    watch_for_recovery()
+    
+    tabs = st.tabs([config["tab_label"] for config in SCENARIOS.values()])
+    for tab, (name, config) in zip(tabs, SCENARIOS.items()):
+        with tab:
+            st.header(config["title"])
+            st.markdown(f"**{config['character']} - {config['role']}**")
             
-            async function speakCustomText() {{
-                const text = chatInput.value.trim();
-                if (!text) return;
-                
-                await speakText(text);
-                chatInput.value = '';
-            }}
+            dialogue_key = f"{name}_dialogue"
+            dialogue = st.session_state.setdefault(dialogue_key, [("assistant", config["opening_line"])])
             
-            function handleKeyPress(event) {{
-                if (event.key === 'Enter') {{
-                    speakCustomText();
-                }}
-            }}
+            # The transcript sits above the input but is filled after it, so a new line shows up straight away
+            transcript = st.container()
+            with st.form(f"{name}_dialogue_form", clear_on_submit=True):
+                text = st.text_input("Your response:", placeholder=f"What would you say to {config['character']}?")
+                if st.form_submit_button("Send") and text.strip():
+                    dialogue.append(("user", text.strip()))
+                    # The character answers with the next scripted line
+                    script = config["text_script"]
+                    replies = sum(1 for role, _ in dialogue if role == "assistant") - 1
+                    dialogue.append(("assistant", script[min(replies, len(script) - 1)]))
             
-            async function stopSession() {{
-                if (!sessionData) return;
-                
-                try {{
-                    updateStatus('Stopping session...', 'loading');
-                    
-                    const response = await fetch('https://api.heygen.com/v1/streaming.stop', {{
-                        method: 'POST',
-                        headers: {{
-                            'Authorization': 'Bearer {access_token}',
-                            'Content-Type': 'application/json'
-                        }},
-                        body: JSON.stringify({{
-                            session_id: sessionData.session_id
-                        }})
-                    }});
-                    
-                    updateStatus('Session stopped', 'success');
-                    isConnected = false;
-                    sessionData = null;
-                    
-                    // Reset UI
-                    startBtn.disabled = false;
-                    speakBtn.disabled = true;
-                    stopBtn.disabled = true;
-                    chatInput.disabled = true;
-                    sendBtn.disabled = true;
-                    
-                    placeholderText.style.display = 'block';
-                    videoElement.style.display = 'none';
-                    placeholderText.textContent = 'Session ended. Click Start to begin again.';
-                    
-                }} catch (error) {{
-                    updateStatus(`Stop error: ${{error.message}}`, 'error');
-                    log(`Stop error: ${{error.message}}`, 'error');
-                }}
-            }}
+            with transcript:
+                for role, line in dialogue:
+                    with st.chat_message(role):
+                        st.markdown(line)
             
-            // Auto-start on load
-            setTimeout(() => {{
-                log('Component loaded, ready to start session');
-                updateStatus('Ready to start session', 'success');
-            }}, 500);
-        </script>
-    </body>
-    </html>
-    """
-    
-    return component_html
+            with st.expander(config["briefing_title"], expanded=True):
+                st.markdown(config["briefing"])
 
 def main():
+    if st.query_params.get("view") == "instructor":
+        render_instructor_dashboard()
+        return
+    
     st.title("🎭 HeyGen Simulation Demo - Fixed Implementation")
+    restore_live_sessions()
     
     # Debug section
     with st.expander("🔧 Debug Information", expanded=False):
@@ -591,8 +1903,8 @@ def main():
         
         with col1:
             if st.button("Test API Connection"):
-                if HEYGEN_API_KEY:
-                    st.success("✅ API Key found")
+                if HEYGEN_API_KEYS:
+                    st.success(f"✅ {len(HEYGEN_API_KEYS)} API key(s) found")
                     token = get_access_token()
                     if token:
                         st.success("✅ Access token generated")
@@ -603,73 +1915,73 @@ def main():
                     st.error("❌ No API Key found")
         
         with col2:
-            if st.button("Test Avatar & Voice IDs"):
-                if HEYGEN_API_KEY:
-                    st.info("Testing your specific avatar and voice configurations...")
-                    
-                    # Test Noa's configuration
-                    st.write("**Testing Noa Martinez:**")
-                    st.write(f"- Avatar ID: `June_HR_public`")
-                    st.write(f"- Voice ID: `c67d6fca1c3d4f55b81fcf9abc37d77f`")
-                    
-                    # Test Sam's configuration  
-                    st.write("**Testing Sam Richards:**")
-                    st.write(f"- Avatar ID: `Shawn_Therapist_public`")
-                    st.write(f"- Voice ID: `0f6610678bfa4a1eb827d128662dca11`")
-                    
-                    # Test voice API
-                    try:
-                        voices_response = requests.get(
-                            "https://api.heygen.com/v2/voices",
-                            headers={"x-api-key": HEYGEN_API_KEY},
-                            timeout=10
-                        )
-                        if voices_response.status_code == 200:
-                            voices_data = voices_response.json().get("data", {}).get("voices", [])
-                            noa_voice_found = any(v.get("voice_id") == "c67d6fca1c3d4f55b81fcf9abc37d77f" for v in voices_data)
-                            sam_voice_found = any(v.get("voice_id") == "0f6610678bfa4a1eb827d128662dca11" for v in voices_data)
-                            
-                            if noa_voice_found:
-                                st.success("✅ Noa's voice ID found")
-                            else:
-                                st.warning("⚠️ Noa's voice ID not found in your account")
-                                
-                            if sam_voice_found:
-                                st.success("✅ Sam's voice ID found")
-                            else:
-                                st.warning("⚠️ Sam's voice ID not found in your account")
-                        else:
-                            st.warning("Could not check voice IDs")
-                    except Exception as e:
-                        st.warning(f"Voice check error: {e}")
+            # Trial sessions are billed, so only instructors can open them from here
+            trial = False
+            if passcode_entered("Instructor passcode for trial sessions:"):
+                trial = st.checkbox("Include trial session (opens and stops a real session)", key="health_check_trial")
+            if st.button("Run Health Check"):
+                if HEYGEN_API_KEYS:
+                    with st.spinner("Checking every scenario's avatar and voice..."):
+                        run_health_check(trial=trial)
                 else:
                     st.error("❌ No API Key found")
+            
+            report = load_health_report()
+            if report:
+                show_health_report(report)
+        if HEYGEN_API_KEYS:
+            st.markdown("**API key pool usage:**")
+            st.dataframe(get_key_pool().snapshot(), use_container_width=True, hide_index=True)
+        
+        breakers = breaker_metrics()
+        if breakers:
+            st.markdown("**HeyGen endpoint circuit breakers:**")
+            metric_cols = st.columns(3)
+            metric_cols[0].metric("Open", sum(b["state"] == "open" for b in breakers))
+            metric_cols[1].metric("Probing", sum(b["state"] == "half-open" for b in breakers))
+            metric_cols[2].metric("Trips", sum(b["trips"] for b in breakers))
+            st.dataframe(breakers, use_container_width=True, hide_index=True)
+        
+        profiling_panel()
+        recording_panel()
 
-    # Get access token
-    access_token = get_access_token()
+    # A token this session already holds keeps its avatars (and any live session) going while the
+    # token endpoint is tripped; without one, skip HeyGen entirely so the page renders immediately
+    access_token = cached_session_token()
     if not access_token:
-        st.error("Cannot proceed without access token")
-        st.info("Please check your HeyGen API key configuration")
-        return
+        if not heygen_available():
+            render_text_only_mode()
+            return
+        
+        # Get access token
+        access_token = get_session_access_token()
+        if not access_token:
+            get_session_registry().record_error(get_client_id())
+            if not heygen_available():
+                render_text_only_mode()
+                return
+            st.error("Cannot proceed without access token")
+            st.info("Please check your HeyGen API key configuration")
+            return
 
     # Custom avatar configurations for your specific characters
     avatar_options = {
         "Noa Martinez (June_HR)": {
-            "id": "June_HR_public", 
+            "id": SCENARIOS["Pre-briefing"]["avatar_id"], 
             "description": "Virtual Clinical Instructor",
-            "voice_id": None  # Will use default compatible voice
+            "voice_id": SCENARIOS["Pre-briefing"]["voice_id"]
         },
         "Sam Richards (Shawn_Therapist)": {
-            "id": "Shawn_Therapist_public", 
+            "id": SCENARIOS["Simulation"]["avatar_id"], 
             "description": "Operations Manager, County Corrections Facility",
-            "voice_id": None  # Will use default compatible voice
+            "voice_id": SCENARIOS["Simulation"]["voice_id"]
         }
     }
     
-    # Get compatible voices for selection
-    compatible_voices = get_compatible_voices()
-    if compatible_voices:
-        st.info(f"✅ Found {len(compatible_voices)} streaming-compatible voices")
+    # Get the indexed voice catalog for selection
+    voice_index = load_voice_index()
+    if voice_index:
+        st.info(f"✅ Found {len(voice_index.streaming)} streaming-compatible voices")
     
     # Get available avatars for reference (optional)
     available_avatars = get_available_avatars()
@@ -688,175 +2000,18 @@ def main():
                 }
     
     # Create tabs for different scenarios
-    tab1, tab2 = st.tabs(["👋 Pre-briefing with Noa Martinez", "🏥 Simulation: Meeting with Sam Richards"])
+    tabs = st.tabs([config["tab_label"] for config in SCENARIOS.values()])
     
-    with tab1:
-        st.header("Pre-briefing with Noa Martinez")
-        st.markdown("**Noa Martinez - Virtual Clinical Instructor**")
-        
-        # Voice configuration options for Noa
-        noa_voice_options = {
-            "Friendly": {"rate": 1.0, "emotion": "friendly"},
-            "Professional": {"rate": 0.9, "emotion": "serious"},
-            "Enthusiastic": {"rate": 1.1, "emotion": "excited"},
-            "Calm": {"rate": 0.8, "emotion": "soothing"},
-        }
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            # Filter to show only Noa's avatar
-            noa_avatars = {k: v for k, v in avatar_options.items() if "Noa Martinez" in k}
-            if not noa_avatars:
-                # Fallback if the specific avatar isn't found
-                noa_avatars = {"Noa Martinez (June_HR)": avatar_options.get("Noa Martinez (June_HR)", {"id": "June_HR_public", "voice_id": None})}
+    for tab, (scenario, config) in zip(tabs, SCENARIOS.items()):
+        with tab:
+            st.header(config["title"])
+            st.markdown(f"**{config['character']} - {config['role']}**")
             
-            selected_avatar = st.selectbox(
-                "Choose Avatar for Noa:",
-                options=list(noa_avatars.keys()),
-                key="noa_avatar"
-            )
-        with col2:
-            # Voice selection from compatible voices
-            if compatible_voices:
-                voice_options = ["Default (No specific voice)"] + list(compatible_voices.keys())
-                selected_voice_key = st.selectbox(
-                    "Voice Selection:",
-                    options=voice_options,
-                    key="noa_voice_selection"
-                )
-                
-                if selected_voice_key == "Default (No specific voice)":
-                    selected_voice_id = None
-                else:
-                    selected_voice_id = compatible_voices[selected_voice_key]["voice_id"]
-            else:
-                selected_voice_key = st.selectbox(
-                    "Voice Style:",
-                    options=list(noa_voice_options.keys()),
-                    key="noa_voice"
-                )
-                selected_voice_id = None
-        
-        if selected_avatar and selected_avatar in noa_avatars:
-            avatar_config = noa_avatars[selected_avatar]
-            voice_config = noa_voice_options.get(selected_voice_key, noa_voice_options["Friendly"])
+            character_panel(scenario, avatar_options, voice_index, access_token)
             
-            # Create HeyGen component for Noa with compatible voice
-            noa_component = create_heygen_component(
-                access_token=access_token,
-                avatar_id=avatar_config["id"],
-                session_id="noa_session",
-                avatar_name="Noa Martinez",
-                voice_id=selected_voice_id or "default",
-                voice_config=voice_config
-            )
-            
-            st.components.v1.html(noa_component, height=700, scrolling=True)
-        
-        # Scenario context
-        with st.expander("📋 Scenario Background", expanded=True):
-            st.markdown("""
-            **Pre-briefing Instructions:**
-            
-            In this scenario, you'll be playing the role of a public health nurse meeting with Sam Richards, 
-            an Operations Manager at a County Corrections Facility. Your goal is to discuss and negotiate the 
-            implementation of a new flu vaccination program for incarcerated individuals.
-            
-            **Key Learning Objectives:**
-            - Practice professional communication in challenging environments
-            - Develop negotiation skills for public health initiatives
-            - Understand the unique challenges of healthcare in correctional facilities
-            
-            **Character Background - Sam Richards:**
-            - 14 years experience in corrections management
-            - Generally resistant to change and new programs
-            - Focuses on security and operational concerns
-            - May be skeptical about healthcare initiatives
-            """)
-    
-    with tab2:
-        st.header("Simulation: Meeting with Sam Richards")
-        st.markdown("**Sam Richards - Operations Manager, County Corrections Facility**")
-        
-        # Voice configuration options for Sam
-        sam_voice_options = {
-            "Professional": {"rate": 0.9, "emotion": "serious"},
-            "Authoritative": {"rate": 0.85, "emotion": "serious"},
-            "Friendly": {"rate": 1.0, "emotion": "friendly"},
-            "Skeptical": {"rate": 0.8, "emotion": "serious"},
-        }
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            # Filter to show only Sam's avatar
-            sam_avatars = {k: v for k, v in avatar_options.items() if "Sam Richards" in k}
-            if not sam_avatars:
-                # Fallback if the specific avatar isn't found
-                sam_avatars = {"Sam Richards (Shawn_Therapist)": avatar_options.get("Sam Richards (Shawn_Therapist)", {"id": "Shawn_Therapist_public", "voice_id": None})}
-            
-            selected_avatar_sam = st.selectbox(
-                "Choose Avatar for Sam:",
-                options=list(sam_avatars.keys()),
-                key="sam_avatar"
-            )
-        with col2:
-            # Voice selection from compatible voices
-            if compatible_voices:
-                voice_options_sam = ["Default (No specific voice)"] + list(compatible_voices.keys())
-                selected_voice_key_sam = st.selectbox(
-                    "Voice Selection:",
-                    options=voice_options_sam,
-                    key="sam_voice_selection"
-                )
-                
-                if selected_voice_key_sam == "Default (No specific voice)":
-                    selected_voice_id_sam = None
-                else:
-                    selected_voice_id_sam = compatible_voices[selected_voice_key_sam]["voice_id"]
-            else:
-                selected_voice_key_sam = st.selectbox(
-                    "Voice Style:",
-                    options=list(sam_voice_options.keys()),
-                    key="sam_voice",
-                    index=0  # Default to Professional for Sam
-                )
-                selected_voice_id_sam = None
-        
-        if selected_avatar_sam and selected_avatar_sam in sam_avatars:
-            avatar_config_sam = sam_avatars[selected_avatar_sam]
-            voice_config_sam = sam_voice_options.get(selected_voice_key_sam, sam_voice_options["Professional"])
-            
-            # Create HeyGen component for Sam with compatible voice
-            sam_component = create_heygen_component(
-                access_token=access_token,
-                avatar_id=avatar_config_sam["id"],
-                session_id="sam_session",
-                avatar_name="Sam Richards",
-                voice_id=selected_voice_id_sam or "default",
-                voice_config=voice_config_sam
-            )
-            
-            st.components.v1.html(sam_component, height=700, scrolling=True)
-        
-        # Simulation context
-        with st.expander("🎯 Simulation Guidelines", expanded=True):
-            st.markdown("""
-            **Your Role:** Public Health Nurse
-            
-            **Objective:** Convince Sam Richards to implement a flu vaccination program
-            
-            **Expected Challenges:**
-            - Resistance to new procedures
-            - Concerns about cost and logistics
-            - Security and safety questions
-            - "We've always done it this way" mentality
-            
-            **Success Strategies:**
-            - Present clear health benefits
-            - Address operational concerns directly
-            - Propose phased implementation
-            - Emphasize regulatory compliance benefits
-            """)
+            # Scenario context
+            with st.expander(config["briefing_title"], expanded=True):
+                st.markdown(config["briefing"])
 
     # Usage instructions
     with st.expander("📖 How to Use", expanded=False):
@@ -888,5 +2043,71 @@ def main():
         - Session lifecycle management following SDK patterns
         """)
 
+def replay_cli(path, speed):
+    """Replay a recording and print original vs replayed latency for every step"""
+    report = replay_recording(path, speed)
+    print(f"{'step':<45} {'at s':>8} {'original ms':>12} {'replay ms':>10} {'delta ms':>9}")
+    for step in report["steps"]:
+        delta = f"{step['delta_ms']:+}" if "delta_ms" in step else "-"
+        replay_ms = "-" if step["replay_ms"] is None else step["replay_ms"]
+        print(f"{step['step']:<45} {step['at_s']:>8.2f} {step['original_ms']:>12} {replay_ms:>10} {delta:>9}")
+    
+    steps = [step for step in report["steps"] if step["replay_ms"] is not None]
+    if steps:
+        original = sum(step["original_ms"] for step in steps)
+        replayed = sum(step["replay_ms"] for step in steps)
+        if speed == 1:
+            print(f"{len(steps)} reruns: {original} ms originally, {replayed} ms replayed ({replayed - original:+} ms)")
+        else:
+            print(f"{len(steps)} reruns: {replayed} ms replayed at {speed:g}x; compare latencies with --speed 1")
+    for message in report["exceptions"]:
+        print(f"App exception during replay: {message}")
+    for request in report["unrecorded_requests"]:
+        print(f"Not in recording, so the replay diverged: {request}")
+    print(f"Report written to {report['path']}")
+    return 1 if report["exceptions"] or report["unrecorded_requests"] else 0
+
+def cli(argv=None):
+    """Command line entry point for deploy-time checks and session replays"""
+    parser = argparse.ArgumentParser(description="HeyGen simulation demo utilities")
+    parser.add_argument("--health-check", action="store_true", help="validate every scenario's avatar and voice")
+    parser.add_argument("--trial", action="store_true", help="also open and stop a real streaming session per scenario")
+    parser.add_argument("--replay", metavar="RECORDING", help="replay a recorded session against a local HeyGen stub")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up factor (default: original timing)")
+    args = parser.parse_args(argv)
+    
+    if args.replay:
+        return replay_cli(args.replay, args.speed)
+    if not args.health_check:
+        parser.print_help()
+        return 0
+    if not HEYGEN_API_KEYS:
+        print("No HeyGen API key configured (HEYGEN_API_KEY or HEYGEN_API_KEYS)")
+        return 1
+    
+    report = run_health_check(trial=args.trial)
+    for error in report["errors"]:
+        print(f"ERROR   could not check {error}")
+    for result in report["scenarios"]:
+        line = (
+            f"{'OK     ' if result['ok'] else 'FAILED '} {result['scenario']} ({result['character']}): "
+            f"avatar {result['avatar_id']} found={result['avatar_found']}, "
+            f"voice {result['voice_id']} found={result['voice_found']} streaming={result['voice_streaming']}"
+        )
+        if "trial" in result:
+            trial_result = result["trial"]
+            line += f", trial={'ok' if trial_result['ok'] else 'failed'} in {trial_result['latency_ms']} ms"
+            if "stop_status" in trial_result:
+                line += f" (stop status {trial_result['stop_status']})"
+            if "error" in trial_result:
+                line += f": {trial_result['error']}"
+        print(line)
+    print(f"Report written to {HEALTH_REPORT_PATH} ({report['duration_ms']} ms)")
+    return 0 if report["ok"] else 1
+
 if __name__ == "__main__":
-    main()
+    # `streamlit run` executes this file with a script run context; plain `python` gets the CLI
+    if get_script_run_ctx() is None:
+        sys.exit(cli())
+    with recorded_rerun("page"):
+        run_with_profiling(main)